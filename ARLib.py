@@ -2,19 +2,19 @@ import attack
 import recommender
 from util.DataLoader import DataLoader
 from util.tool import isClass, getPopularItemId, dataSave, targetItemSelect
-from util.metrics import AttackMetric
+from util.metrics import AttackMetric, format_ranking
 import time
 import random
 import numpy as np
 from time import strftime, localtime, time
 from os.path import abspath
 import sys
-import re
 import logging
 import os
 from shutil import copyfile
 from copy import deepcopy
 import torch
+from util.store import ModelStore
 
 
 class ARLib():
@@ -96,27 +96,20 @@ class ARLib():
         train recommender, if data is clean, attack is None, if attack need gradient, requires_grad is True
         """
         if attack is None:
-            # Recommend in clean data
-            if not os.path.exists(self.recommendArg.save_dir):
-                os.makedirs(self.recommendArg.save_dir)
-            if not os.path.exists(self.recommendArg.save_dir + self.recommendModelName):
-                os.makedirs(self.recommendArg.save_dir + self.recommendModelName)
-            if self.recommendArg.load and os.path.exists(
-                    self.recommendArg.save_dir + self.recommendModelName + "/" + self.recommendModelName + "_" + str(
-                        self.recommendArg.emb_size) + "_"
-                    + str(self.recommendArg.n_layers) + "_" + self.datasetName):
-                print("Model is exist in {}, loading...".format(
-                    self.recommendArg.save_dir + self.recommendModelName + "/" + self.recommendModelName + "_" + str(
-                        self.recommendArg.emb_size) + "_"
-                    + str(self.recommendArg.n_layers) + "_" + self.datasetName))
-                self.recommendModel = torch.load(
-                    self.recommendArg.save_dir + self.recommendModelName + "/" + self.recommendModelName + "_" + str(
-                        self.recommendArg.emb_size) + "_"
-                    + str(self.recommendArg.n_layers) + "_" + self.datasetName)
-                self.recommendModel.top = self.recommendArg.topK.split(',')
-                self.recommendModel.topN = [int(num) for num in self.recommendModel.top]
-                self.recommendModel.max_N = max(self.recommendModel.topN)
-            else:
+            # Recommend in clean data, reused from the store when this exact configuration was trained before
+            store = ModelStore(self.recommendArg.save_dir, self.recommendArg.save_budget)
+            key = ModelStore.key(self.recommendArg, self.recommendModel.data)
+            path = store.get(key) if self.recommendArg.load else None
+            if path is not None:
+                print("Model is exist in {}, loading...".format(path))
+                try:
+                    self.recommendModel = type(self.recommendModel).load_checkpoint(path, self.recommendArg,
+                                                                                    self.recommendModel.data)
+                except OSError:
+                    # evicted by another run sharing save_dir between get() and loading, trained again
+                    print("Model in {} was removed while loading, retraining...".format(path))
+                    path = None
+            if path is None:
                 if self.requires_grad:
                     self.grad = self.recommendModel.train(requires_grad=self.requires_grad)
                 else:
@@ -125,25 +118,23 @@ class ARLib():
                     except:
                         self.recommendModel.train()
                 if self.recommendArg.save:
-                    torch.save(self.recommendModel,
-                               self.recommendArg.save_dir + self.recommendModelName + "/" + self.recommendModelName + "_" + str(
-                                   self.recommendArg.emb_size) + "_"
-                               + str(self.recommendArg.n_layers) + "_" + self.datasetName)
+                    store.put(key, self.recommendModel.save_checkpoint,
+                              dict(model=self.recommendModelName, dataset=self.datasetName,
+                                   config=ModelStore.config(self.recommendArg)))
+            # clean parameters the poisoned retraining is warm-started from
+            self.cleanData = self.recommendModel.data
+            self.cleanState = {k: v.detach().clone() for k, v in self.recommendModel.model.state_dict().items()}
         else:
             # Recommend in poisoning data
             poisonArg = self.recommendArg
             poisonArg.dataset = self.poisonDataName + "/" + str(attack)
             poisonArg.data_path = "data/poison/"
             poisonData = DataLoader(poisonArg)
-            Pu, Pi = self.recommendModel.model()
             self.recommendModel.__init__(poisonArg, poisonData)
-            if self.requires_grad:
-                self.grad = self.recommendModel.train(requires_grad=requires_grad)
-            else:
-                try:
-                    self.recommendModel.train(requires_grad=False)
-                except:
-                    self.recommendModel.train()
+            if self.recommendArg.warmEpoch:
+                # shared users and items start from the clean model, fake users from scratch
+                self.recommendModel.warm_start(self.cleanState, self.cleanData)
+            self.recommendModel.train(Epoch=self.recommendArg.warmEpoch)
 
             # torch.save(self.recommendModel,
             #         self.recommendArg.save_dir + self.recommendModelName + "/" + self.recommendModelName + "_" + str(
@@ -160,35 +151,17 @@ class ARLib():
             message = "Recommender model {} is tested in clean data".format(self.recommendModelName)
             message += "\n" * 2 + "-" * 10 + "Test Result (Evaluation Metrics @Top-({})) in Clean Data".format(
                 self.recommendArg.topK) + "-" * 10 + "\n"
-            for i in self.rawRecommendresult:
-                message += i
+            message += ''.join(format_ranking(self.rawRecommendresult))
             self.logger.info(message)
             print(message)
         else:
             # recommender test  result in poison data
             _, self.attackRecommendresult = self.recommendModel.test()
-            self.result.append(dict())
-            tempName = "Top 10\n"
-            for i in range(len(self.rawRecommendresult)):
-                if "Top" in self.rawRecommendresult[i]:
-                    tempName = self.rawRecommendresult[i]
-                    self.result[-1][tempName] = dict()
-                else:
-                    self.result[-1][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] = (float(
-                        re.sub("[^0-9\.]", "", self.attackRecommendresult[i])) - float(
-                        re.sub("[^0-9\.]", "", self.rawRecommendresult[i]))) / float(
-                        re.sub("[^0-9\.]", "", self.rawRecommendresult[i]))
-
-            self.RecommendTestResult.append(dict())
-            tempName = "Top 10\n"
-            for i in range(len(self.rawRecommendresult)):
-                if "Top" in self.rawRecommendresult[i]:
-                    tempName = self.rawRecommendresult[i]
-                    self.RecommendTestResult[-1][tempName] = dict()
-                else:
-                    self.RecommendTestResult[-1][tempName][
-                        re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] = float(
-                        re.sub("[^0-9\.]", "", self.attackRecommendresult[i]))
+            raw, poisoned = self.rawRecommendresult, self.attackRecommendresult
+            # relative change of every metric against the clean model
+            self.result.append({"Top " + str(n): {k: (poisoned[n][k] - raw[n][k]) / raw[n][k] for k in raw[n]}
+                                for n in raw})
+            self.RecommendTestResult.append({"Top " + str(n): dict(poisoned[n]) for n in poisoned})
 
             attackmetrics = AttackMetric(self.recommendModel, self.targetItem, self.top)
             self.hitRate.append(attackmetrics.hitRate())
@@ -196,18 +169,11 @@ class ARLib():
             self.recall.append(attackmetrics.recall())
             self.ndcg.append(attackmetrics.NDCG())
 
-            result = dict()
-            for i, j in enumerate(self.top):
-                result["Top " + str(j)] = dict()
-                result["Top " + str(j)]["HitRate"] = self.hitRate[-1][i]
-                result["Top " + str(j)]["Precision"] = self.precision[-1][i]
-                result["Top " + str(j)]["Recall"] = self.recall[-1][i]
-                result["Top " + str(j)]["NDCG"] = self.ndcg[-1][i]
+            result = {"Top " + str(k): v for k, v in attackmetrics.result().items()}
 
             message = "\n" * 2 + "-" * 10 + "Recommender Test Result in Poisoning Environment No.{} (Evaluation Metrics @Top-({}))". \
                 format(attack, self.recommendArg.topK) + "-" * 10 + "\n"
-            for i in self.attackRecommendresult:
-                message += i
+            message += ''.join(format_ranking(self.attackRecommendresult))
             message += "\n" + "-" * 10 + "Target Attack Test Result in Poisoning Environment No.{} (Evaluation Metrics @Top-({}))". \
                 format(attack, self.recommendArg.topK) + "-" * 10
             for i in result.keys():
@@ -276,45 +242,24 @@ class ARLib():
         for i in range(len(self.ndcg[0])):
             self.avgNDCGAttack.append(sum(map(lambda x: x[i], self.ndcg)) / len(self.ndcg))
 
-        tempName = "Top 10\n"
-        for i in range(len(self.rawRecommendresult)):
-            if "Top" in self.rawRecommendresult[i]:
-                tempName = self.rawRecommendresult[i]
-                if len(self.result)!=1:self.result[-1][tempName] = dict()
-            elif len(self.result)==1:
-                self.result[-1][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] =\
-                    self.result[0][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]]
-            else:
-                self.result[-1][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] = sum(
-                    [self.result[j][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] for j in
-                     range(len(self.result) - 1)]) / (len(self.result) - 1)
-
-        tempName = "Top 10\n"
-        for i in range(len(self.rawRecommendresult)):
-            if "Top" in self.rawRecommendresult[i]:
-                tempName = self.rawRecommendresult[i]
-                if len(self.RecommendTestResult)!=1:self.RecommendTestResult[-1][tempName] = dict()
-            elif len(self.RecommendTestResult)==1:
-                self.RecommendTestResult[-1][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] =\
-                    self.RecommendTestResult[0][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]]
-            else:
-                self.RecommendTestResult[-1][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] = sum(
-                    [self.RecommendTestResult[j][tempName][re.sub("[0-9\.]", "", self.rawRecommendresult[i])[:-1]] for j
-                     in
-                     range(len(self.RecommendTestResult) - 1)]) / (len(self.RecommendTestResult) - 1)
+        def average(results):
+            return {n: {k: sum(r[n][k] for r in results) / len(results) for k in results[0][n]} for n in results[0]}
+
+        self.avgRecommendTestResult = average(self.RecommendTestResult)
+        self.avgResult = average(self.result)
 
         message = "\n" * 2 + "-" * 10 + "Recommender Test Result in Poisoning Environment on Average (Evaluation Metrics @Top-({}))".format(
             self.recommendArg.topK) + "-" * 10 + "\n"
-        for i in self.RecommendTestResult[-1].keys():
-            message += str(i)
-            for j in self.RecommendTestResult[-1][i].keys():
-                message += str(j) + " : " + str(self.RecommendTestResult[-1][i][j]) + "\n"
+        for i in self.avgRecommendTestResult.keys():
+            message += str(i) + "\n"
+            for j in self.avgRecommendTestResult[i].keys():
+                message += str(j) + " : " + str(self.avgRecommendTestResult[i][j]) + "\n"
 
         message += "\n" + "-" * 10 + " Global Recommender Performance Variation" + "-" * 10 + "\n"
-        for i in self.result[-1].keys():
-            message += str(i)
-            for j in self.result[-1][i].keys():
-                message += str(j) + " : " + str(self.result[-1][i][j]) + "\n"
+        for i in self.avgResult.keys():
+            message += str(i) + "\n"
+            for j in self.avgResult[i].keys():
+                message += str(j) + " : " + str(self.avgResult[i][j]) + "\n"
 
         result = dict()
         for i, j in enumerate(self.top):
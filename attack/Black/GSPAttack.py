@@ -10,6 +10,7 @@ from recommender.NGCF import NGCF
 import math
 import argparse
 from conf.recommend_parser import recommend_parse_args
+from util.device import get_device
 
 class GSPAttack():
     def __init__(self, arg, data):
@@ -51,7 +52,7 @@ class GSPAttack():
         self.alpha = 1
         self.beta = 1
         self.batchSize = 128
-        self.ngcf = NGCFProxy(data, 64, 2, self.fakeUserNum, self.maliciousFeedbackNum).cuda()
+        self.ngcf = NGCFProxy(data, 64, 2, self.fakeUserNum, self.maliciousFeedbackNum).to(get_device())
 
     def posionDataAttack(self):
         recommender = self.ngcf
@@ -66,12 +67,12 @@ class GSPAttack():
                                 @ Pi.T)
             L_per = 0
             with torch.no_grad():
-                uiAdj = recommender.adj_mat.to_dense()[:self.userNum+self.fakeUserNum,:self.itemNum].cuda()
+                uiAdj = recommender.adj_mat.to_dense()[:self.userNum+self.fakeUserNum,:self.itemNum].to(get_device())
             k = 0
             for batch in range(0,self.userNum + self.fakeUserNum, self.batchSize):
                 k += 1
-                L_per += -(uiAdj[batch:batch + self.batchSize, :] * torch.log(F.sigmoid(scores[batch:batch + self.batchSize, :]).cuda() + 10e-8)+
-                (1 - uiAdj[batch:batch + self.batchSize, :]) * (torch.log(1 - F.sigmoid(scores[batch:batch + self.batchSize, :].cuda()) + 10e-8))).mean()
+                L_per += -(uiAdj[batch:batch + self.batchSize, :] * torch.log(F.sigmoid(scores[batch:batch + self.batchSize, :]).to(get_device()) + 10e-8)+
+                (1 - uiAdj[batch:batch + self.batchSize, :]) * (torch.log(1 - F.sigmoid(scores[batch:batch + self.batchSize, :].to(get_device())) + 10e-8))).mean()
             L_per = L_per / k
             L_exPR = 0
             k = 0
@@ -141,7 +142,7 @@ class NGCFProxy(nn.Module):
         self.mlp = MLP(2 * self.latent_size, int(math.sqrt(self.data.item_num)))
         self.embedding_dict, self.W = self._init_model()
         
-        self.adj_mat = self.__create_sparse_torch_adjacency().cuda()
+        self.adj_mat = self.__create_sparse_torch_adjacency().to(get_device())
         self.norm_adj = self.__create_sparse_torch_norm_adjacency(self.adj_mat)
         self.Pu = None
         self.maliciousFeedbackNum = maliciousFeedbackNum
@@ -229,13 +230,3 @@ class NGCFProxy(nn.Module):
             mask[range(mask.shape[0]),torch.argmax(out_tmp,dim=1)] = -10e9
             out += out_tmp
         return out
-class TorchGraphInterface(object):
-    def __init__(self):
-        pass
-
-    @staticmethod
-    def convert_sparse_mat_to_tensor(X):
-        coo = X.tocoo()
-        i = torch.LongTensor([coo.row, coo.col])
-        v = torch.from_numpy(coo.data).float()
-        return torch.sparse.FloatTensor(i, v, coo.shape)
\ No newline at end of file
@@ -18,6 +18,8 @@ from scipy.sparse import vstack, csr_matrix
 from stable_baselines3.common.policies import BasePolicy, ActorCriticPolicy, MultiInputActorCriticPolicy, partial
 from stable_baselines3.common.torch_layers import BaseFeaturesExtractor, MlpExtractor
 from stable_baselines3.common.distributions import Distribution
+from util.device import get_device
+from util.graph import bipartite_graph
 
 
 class PoisonRec():
@@ -62,7 +64,7 @@ class PoisonRec():
         if self.env is None:
             # policy_kwargs = dict(features_extractor_class=CustomFeaturesExtractor)
             self.env = MyEnv(self.item_num, self.fakeUser, self.maliciousFeedbackNum, self.recommender, self.targetItem)
-            self.agent = PPO(CustomPolicy, self.env, verbose=1, clip_range=0.1, gamma=1,n_steps=20,n_epochs=10)
+            self.agent = PPO(CustomPolicy, self.env, device=get_device(), verbose=1, clip_range=0.1, gamma=1,n_steps=20,n_epochs=10)
             self.agent.learn(total_timesteps=400)
         self.env = MyEnv(self.item_num, self.fakeUser, self.maliciousFeedbackNum, self.recommender, self.targetItem)
         while not self.env.fakeUserDone:
@@ -82,25 +84,9 @@ class PoisonRec():
 
     def fakeUserInject(self, recommender):
         Pu, Pi = recommender.model()
-        recommender.data.user_num += self.fakeUserNum
-        for i in range(self.fakeUserNum):
-            recommender.data.user["fakeuser{}".format(i)] = len(recommender.data.user)
-            recommender.data.id2user[len(recommender.data.user) - 1] = "fakeuser{}".format(i)
-
-        self.fakeUser = list(range(self.userNum, self.userNum + self.fakeUserNum))
-        row, col, entries = [], [], []
-        for u in self.fakeUser:
-            sampleItem =  self.targetItem
-            for i in sampleItem:
-                recommender.data.training_data.append((recommender.data.id2user[u],recommender.data.id2item[i]))
-        for pair in recommender.data.training_data:
-            row += [recommender.data.user[pair[0]]]
-            col += [recommender.data.item[pair[1]]]
-            entries += [1.0]
-
-        recommender.data.interaction_mat = sp.csr_matrix((entries, (row, col)),
-                                                         shape=(recommender.data.user_num, recommender.data.item_num),
-                                                         dtype=np.float32)
+        fakeItems = [list(self.targetItem) for _ in range(self.fakeUserNum)]
+        self.fakeUser = list(recommender.data.append_users(
+            fakeItems, ["fakeuser{}".format(i) for i in range(self.fakeUserNum)]))
 
         recommender.__init__(recommender.args, recommender.data)
         with torch.no_grad():
@@ -115,7 +101,7 @@ class PoisonRec():
                 recommender.model.embedding_dict['item_mf_emb'][:] = Pi[:, :Pi.shape[1]//2]
                 recommender.model.embedding_dict['item_mlp_emb'][:] = Pi[:, Pi.shape[1]//2:]
 
-        recommender.model = recommender.model.cuda()
+        recommender.model = recommender.model.to(get_device())
 
 
 
@@ -167,7 +153,7 @@ class MyEnv(gym.Env):
         self.state["itemInteract"][self.targetItem] = 1
         self.fakeUserInjectChange(self.recommender, self.fakeUserid, self.itemList)
         attackmetrics = AttackMetric(self.recommender, self.targetItem, [50])
-        reward = attackmetrics.hitRate() * self.recommender.data.user_num
+        reward = attackmetrics.hitRateEstimate().value * self.recommender.data.user_num
         done = True
         if self.fakeUserid == self.fakeUserNum - 1: self.fakeUserDone = True
         self.fakeUserid = (self.fakeUserid + 1) % self.fakeUserNum
@@ -182,11 +168,7 @@ class MyEnv(gym.Env):
         uiAdj2 = uiAdj[:, :]
         uiAdj2[self.fakeUser[fakeUserId],:] = 0  
         uiAdj2[self.fakeUser[fakeUserId],self.itemList] = 1
-        ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-            self.userNum + self.itemNum, self.userNum  + self.itemNum),
-                                dtype=np.float32)
-        ui_adj[:self.userNum , self.userNum:] = uiAdj2
-        recommender.model._init_uiAdj(ui_adj + ui_adj.T)
+        recommender.model._init_uiAdj(bipartite_graph(uiAdj2))
 
 class CustomFeaturesExtractor(BaseFeaturesExtractor):
     def __init__(self, observation_space, features_dim=64):
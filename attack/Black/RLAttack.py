@@ -14,6 +14,8 @@ from util.tool import targetItemSelect
 from util.metrics import AttackMetric
 from scipy.sparse import vstack, csr_matrix
 from stable_baselines3.common.torch_layers import BaseFeaturesExtractor
+from util.device import get_device
+from util.graph import bipartite_graph
 
 
 class RLAttack():
@@ -57,7 +59,7 @@ class RLAttack():
         self.fakeUserInject(self.recommender)
         if self.env is None:
             self.env = MyEnv(self.item_num, self.fakeUser, self.maliciousFeedbackNum, self.recommender, self.targetItem)
-            self.agent = PPO('MlpPolicy', self.env, verbose=1, clip_range=0.1, gamma=1,n_steps=20,n_epochs=10)
+            self.agent = PPO('MlpPolicy', self.env, device=get_device(), verbose=1, clip_range=0.1, gamma=1,n_steps=20,n_epochs=10)
             self.agent.learn(total_timesteps=400)
         self.env = MyEnv(self.item_num, self.fakeUser, self.maliciousFeedbackNum, self.recommender, self.targetItem)
         while not self.env.fakeUserDone:
@@ -77,25 +79,9 @@ class RLAttack():
 
     def fakeUserInject(self, recommender):
         Pu, Pi = recommender.model()
-        recommender.data.user_num += self.fakeUserNum
-        for i in range(self.fakeUserNum):
-            recommender.data.user["fakeuser{}".format(i)] = len(recommender.data.user)
-            recommender.data.id2user[len(recommender.data.user) - 1] = "fakeuser{}".format(i)
-
-        self.fakeUser = list(range(self.userNum, self.userNum + self.fakeUserNum))
-        row, col, entries = [], [], []
-        for u in self.fakeUser:
-            sampleItem =  self.targetItem
-            for i in sampleItem:
-                recommender.data.training_data.append((recommender.data.id2user[u],recommender.data.id2item[i]))
-        for pair in recommender.data.training_data:
-            row += [recommender.data.user[pair[0]]]
-            col += [recommender.data.item[pair[1]]]
-            entries += [1.0]
-
-        recommender.data.interaction_mat = sp.csr_matrix((entries, (row, col)),
-                                                         shape=(recommender.data.user_num, recommender.data.item_num),
-                                                         dtype=np.float32)
+        fakeItems = [list(self.targetItem) for _ in range(self.fakeUserNum)]
+        self.fakeUser = list(recommender.data.append_users(
+            fakeItems, ["fakeuser{}".format(i) for i in range(self.fakeUserNum)]))
 
         recommender.__init__(recommender.args, recommender.data)
         with torch.no_grad():
@@ -110,7 +96,7 @@ class RLAttack():
                 recommender.model.embedding_dict['item_mf_emb'][:] = Pi[:, :Pi.shape[1]//2]
                 recommender.model.embedding_dict['item_mlp_emb'][:] = Pi[:, Pi.shape[1]//2:]
 
-        recommender.model = recommender.model.cuda()
+        recommender.model = recommender.model.to(get_device())
 
 
 
@@ -166,7 +152,7 @@ class MyEnv(gym.Env):
         self.state[self.targetItem] = 1
         self.fakeUserInjectChange(self.recommender, self.fakeUserid, self.itemList)
         attackmetrics = AttackMetric(self.recommender, self.targetItem, [50])
-        reward = attackmetrics.hitRate()*self.recommender.data.user_num
+        reward = attackmetrics.hitRateEstimate().value * self.recommender.data.user_num
         done = True
         if self.fakeUserid == self.fakeUserNum - 1: self.fakeUserDone = True
         self.fakeUserid = (self.fakeUserid + 1) % self.fakeUserNum
@@ -200,8 +186,4 @@ class MyEnv(gym.Env):
         uiAdj2 = uiAdj[:, :]
         uiAdj2[self.fakeUser[fakeUserId],:] = 0  
         uiAdj2[self.fakeUser[fakeUserId],self.itemList] = 1
-        ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-            self.userNum + self.itemNum, self.userNum  + self.itemNum),
-                                dtype=np.float32)
-        ui_adj[:self.userNum , self.userNum:] = uiAdj2
-        recommender.model._init_uiAdj(ui_adj + ui_adj.T)
+        recommender.model._init_uiAdj(bipartite_graph(uiAdj2))
@@ -5,6 +5,7 @@ import torch.nn as nn
 from util.tool import targetItemSelect
 import scipy.sparse as sp
 from scipy.sparse import vstack,csr_matrix
+from util.device import get_device
 
 
 class AUSH():
@@ -53,8 +54,8 @@ class AUSH():
         if self.G is None:
             self.selectItem = random.sample(set(list(range(self.itemNum)))-set(self.targetItem), self.itemNum//5)  + self.targetItem
 
-            G = Generator(len(self.selectItem)).cuda()
-            D = Discriminator(len(self.selectItem)).cuda()
+            G = Generator(len(self.selectItem)).to(get_device())
+            D = Discriminator(len(self.selectItem)).to(get_device())
             optimize_G = torch.optim.Adam(G.parameters(), lr=0.005)
             optimize_D = torch.optim.Adam(D.parameters(), lr=0.005)
             for i in range(self.BiLevelOptimizationEpoch):
@@ -79,7 +80,7 @@ class AUSH():
                     coo = tempInteract.tocoo()
                     inds = torch.LongTensor([coo.row, coo.col])
                     values = torch.from_numpy(coo.data).float()
-                    tempInteract = torch.sparse.FloatTensor(inds, values, coo.shape).cuda()
+                    tempInteract = torch.sparse.FloatTensor(inds, values, coo.shape).to(get_device())
                     # mat1 = self.interact[userSet,:]
                     # mat2 = torch.tensor(tempInteract)
                     # tempInteract = torch.sparse.FloatTensor(mat1._indices(), mat1._values() * mat2[mat1._indices()[0], mat1._indices()[1]],
@@ -111,13 +112,13 @@ class AUSH():
                     coo = tempInteract.tocoo()
                     inds = torch.LongTensor([coo.row, coo.col])
                     values = torch.from_numpy(coo.data).float()
-                    tempInteract = torch.sparse.FloatTensor(inds, values, coo.shape).cuda()
+                    tempInteract = torch.sparse.FloatTensor(inds, values, coo.shape).to(get_device())
                     fakeInteract = G(tempInteract)
-                    maskTarget = torch.zeros((len(self.selectItem), 1)).cuda()
+                    maskTarget = torch.zeros((len(self.selectItem), 1), device=get_device())
                     maskTarget[[self.selectItem.index(i) for i in self.targetItem]] = 1
                     Q = torch.ones_like(fakeInteract)
                     L_recon = (fakeInteract - tempInteract) ** 2
-                    L_shill = ((Q.cuda() - fakeInteract) @ maskTarget) ** 2
+                    L_shill = ((Q.to(get_device()) - fakeInteract) @ maskTarget) ** 2
                     L_GD = torch.log(D(tempInteract)).mean() + torch.log(1 - D(fakeInteract)).mean()
                     loss2 = L_GD + L_shill.mean() + L_recon.mean()
                     optimize_G.zero_grad()
@@ -148,7 +149,7 @@ class AUSH():
         row, col, entries = [], [], []
         self.fakeUser = list(range(self.userNum, self.userNum + self.fakeUserNum))
         for step, u in enumerate(self.fakeUser):
-            fakeRat = self.G(tempInteract[step].cuda()).detach().cpu().numpy()
+            fakeRat = self.G(tempInteract[step].to(get_device())).detach().cpu().numpy()
             # fakeRat[list(set(list(range(self.itemNum)))-set(self.selectItem))] = -10e8
             fakeRat = self.project(fakeRat, self.maliciousFeedbackNum)
             ind = fakeRat.nonzero()
@@ -163,7 +164,7 @@ class AUSH():
                 col += [c]
                 entries += [1]
         fakeRat = csr_matrix((entries, (row, col)), shape=(len(self.fakeUser), self.itemNum), dtype=np.float32)
-        # print("tureScore:{}".format(self.D(tempInteract.cuda()).mean()))
+        # print("tureScore:{}".format(self.D(tempInteract.to(get_device())).mean()))
         return vstack([self.interact, fakeRat])
 
     # def project(self, mat, n):
@@ -2,16 +2,18 @@ import numpy as np
 import random
 import torch
 import torch.nn as nn
+from util.sampler import HardNegativePool
 from util.tool import targetItemSelect
 from util.metrics import AttackMetric
 from util.algorithm import find_k_largest
 import torch.nn.functional as F
 import scipy.sparse as sp
-from copy import deepcopy
 from util.loss import bpr_loss, l2_reg_loss
 from sklearn.neighbors import LocalOutlierFactor as LOF
 from recommender.GMF import GMF
 import logging
+from util.device import get_device
+from util.graph import PoisonGraph
 
 
 class FedRecAttack():
@@ -54,41 +56,29 @@ class FedRecAttack():
 
     def posionDataAttack(self, recommender):
         self.fakeUserInject(recommender)
-        uiAdj = recommender.data.matrix()
+        uiAdj = PoisonGraph(recommender.data.matrix(), self.userNum)
         optimizer = torch.optim.Adam(recommender.model.parameters(), lr=recommender.args.lRate / 10)
         topk = min(recommender.topN)
+        hardNegatives = HardNegativePool(topk, block_size=self.batchSize)
         bestTargetHitRate = -1
+        snapshot = None
         for epoch in range(self.Epoch):
             # outer optimization
-            tmpRecommender = deepcopy(recommender)
-            uiAdj2 = uiAdj[:, :]
-            ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-                self.userNum + self.fakeUserNum + self.itemNum, self.userNum + self.fakeUserNum + self.itemNum),
-                                    dtype=np.float32)
-            ui_adj[:self.userNum + self.fakeUserNum, self.userNum + self.fakeUserNum:] = uiAdj2
-            tmpRecommender.model._init_uiAdj(ui_adj + ui_adj.T)
+            # try the attack on the recommender itself, its parameters are rolled back before the inner training
+            snapshot = recommender.snapshot(snapshot, optimizer)
+            tmpRecommender = recommender
+            uiAdj2 = uiAdj.copy()
+            tmpRecommender.model._init_uiAdj(uiAdj2.adjacency())
             optimizer_attack = torch.optim.Adam(tmpRecommender.model.parameters(), lr=recommender.args.lRate)
             for _ in range(self.outerEpoch):
                 # Pu, Pi = tmpRecommender.model()
                 # We do not know Pu, so learn Pu
-                optimizer = torch.optim.Adam([tmpRecommender.model.embedding_dict["user_emb"]], lr=recommender.args.lRate)
-                tmpRecommender.train(Epoch=5, optimizer=optimizer, evalNum=5)
+                optimizer_user = torch.optim.Adam([tmpRecommender.model.embedding_dict["user_emb"]], lr=recommender.args.lRate)
+                tmpRecommender.train(Epoch=5, optimizer=optimizer_user, evalNum=5)
                 Pu, Pi = tmpRecommender.model()
 
-                scores = torch.zeros((self.userNum + self.fakeUserNum, self.itemNum))
-                for batch in range(0,self.userNum + self.fakeUserNum, self.batchSize):
-                    scores[batch:batch + self.batchSize, :] = (Pu[batch:batch + self.batchSize, :] \
-                                    @ Pi.T).detach()
-                nozeroInd = uiAdj2.nonzero()
-                scores[nozeroInd[0],nozeroInd[1]] = -10e8
-                _, top_items = torch.topk(scores, topk)
-                top_items = [[iid.item() for iid in user_top] for user_top in top_items]
-                users, pos_items, neg_items = [], [], []
-                for idx, u_index in enumerate(list(range(self.userNum))):
-                    for item in self.targetItem:
-                        users.append(u_index)
-                        pos_items.append(item)
-                        neg_items.append(top_items[u_index].pop())
+                hardNegatives.update(Pu, Pi, uiAdj2.clean, self.userNum)
+                users, pos_items, neg_items = hardNegatives.cw_triples(range(self.userNum), self.targetItem)
                 user_emb = Pu[users]
                 pos_items_emb = Pi[pos_items]
                 neg_items_emb = Pi[neg_items]
@@ -100,73 +90,37 @@ class FedRecAttack():
                 CWloss.backward()
                 optimizer_attack.step()
             for batch in range(0,len(self.fakeUser),self.batchSize):
-                uiAdj2[self.fakeUser[batch:batch + self.batchSize], :] = (Pu[self.fakeUser[batch:batch + self.batchSize], :] @ Pi.T).detach().cpu().numpy()
-            uiAdj2[self.fakeUser, :] = self.project(uiAdj2[self.fakeUser, :],
-                                                          self.maliciousFeedbackNum)
-            for u in self.fakeUser:
-                uiAdj2[u,self.targetItem] = 1
+                uiAdj2.fake[batch:batch + self.batchSize] = (Pu[self.fakeUser[batch:batch + self.batchSize], :] @ Pi.T).detach().cpu().numpy()
+            uiAdj2.project(self.maliciousFeedbackNum)
+            uiAdj2.fill(self.targetItem)
 
-            uiAdj = uiAdj2[:, :]
+            uiAdj = uiAdj2.copy()
 
-            # inner optimization
-            ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-                self.userNum + self.fakeUserNum + self.itemNum, self.userNum + self.fakeUserNum + self.itemNum),
-                                   dtype=np.float32)
-            ui_adj[:self.userNum + self.fakeUserNum, self.userNum + self.fakeUserNum:] = uiAdj
+            recommender.restore(snapshot, optimizer)
 
-            recommender.model._init_uiAdj(ui_adj + ui_adj.T)
+            # inner optimization
+            recommender.model._init_uiAdj(uiAdj.adjacency())
             recommender.train(Epoch=self.innerEpoch, optimizer=optimizer, evalNum=5)
 
+            # sampled estimate, grown until it separates from the best hit rate so far
             attackmetrics = AttackMetric(recommender, self.targetItem, [topk])
-            targetHitRate = attackmetrics.hitRate()[0]
+            targetHitRate = attackmetrics.hitRateEstimate(versus=bestTargetHitRate).value
             print(targetHitRate)
             if targetHitRate > bestTargetHitRate:
-                bestAdj = uiAdj[:,:]
+                bestAdj = uiAdj.copy()
                 bestTargetHitRate = targetHitRate
             
-            uiAdj = bestAdj[:,:]
+            uiAdj = bestAdj.copy()
             
             print("BiLevel epoch {} is over\n".format(epoch + 1))
         self.interact = bestAdj
         return self.interact
 
-    def project(self, mat, n):
-        try:
-            matrix = torch.tensor(mat[:, :].todense())
-            _, indices = torch.topk(matrix, n, dim=1)
-            matrix.zero_()
-            matrix.scatter_(1, indices, 1)
-        except:
-            matrix = mat[:,:]
-            for i in range(matrix.shape[0]):
-                subMatrix = torch.tensor(matrix[i, :].todense())
-                topk_values, topk_indices = torch.topk(subMatrix, n)
-                subMatrix.zero_()  
-                subMatrix[0, topk_indices] = 1
-                matrix[i, :] = subMatrix[:, :].flatten()
-        return matrix
-
     def fakeUserInject(self, recommender):
         Pu, Pi = recommender.model()
-        recommender.data.user_num += self.fakeUserNum
-        for i in range(self.fakeUserNum):
-            recommender.data.user["fakeuser{}".format(i)] = len(recommender.data.user)
-            recommender.data.id2user[len(recommender.data.user) - 1] = "fakeuser{}".format(i)
-
-        self.fakeUser = list(range(self.userNum, self.userNum + self.fakeUserNum))
-        row, col, entries = [], [], []
-        for u in self.fakeUser:
-            sampleItem =  random.sample(set(list(range(self.itemNum))),self.maliciousFeedbackNum)
-            for i in sampleItem:
-                recommender.data.training_data.append((recommender.data.id2user[u],recommender.data.id2item[i]))
-        for pair in recommender.data.training_data:
-            row += [recommender.data.user[pair[0]]]
-            col += [recommender.data.item[pair[1]]]
-            entries += [1.0]
-
-        recommender.data.interaction_mat = sp.csr_matrix((entries, (row, col)),
-                                                         shape=(recommender.data.user_num, recommender.data.item_num),
-                                                         dtype=np.float32)
+        fakeItems = [random.sample(range(self.itemNum), self.maliciousFeedbackNum) for _ in range(self.fakeUserNum)]
+        self.fakeUser = list(recommender.data.append_users(
+            fakeItems, ["fakeuser{}".format(i) for i in range(self.fakeUserNum)]))
 
         recommender.__init__(recommender.args, recommender.data)
 
@@ -174,4 +128,4 @@ class FedRecAttack():
             recommender.model.embedding_dict['user_emb'][:Pu.shape[0]] = Pu
             recommender.model.embedding_dict['item_emb'][:] = Pi
 
-        recommender.model = recommender.model.cuda()
+        recommender.model = recommender.model.to(get_device())
@@ -5,6 +5,7 @@ import torch.nn as nn
 from util.algorithm import l2
 from util.tool import targetItemSelect
 from scipy.sparse import vstack,csr_matrix
+from util.device import get_device
 
 
 class GOAT():
@@ -48,8 +49,8 @@ class GOAT():
             # print("hava no trained Generator, Generator training")
             k = self.maliciousFeedbackNum
             self.k = k
-            self.G = Encoder(k).cuda()
-            self.D = Decoder(k).cuda()
+            self.G = Encoder(k).to(get_device())
+            self.D = Decoder(k).to(get_device())
             optimize_G = torch.optim.Adam(self.G.parameters(), lr=0.005)
             optimize_D = torch.optim.Adam(self.D.parameters(), lr=0.005)
             for i in range(self.BiLevelOptimizationEpoch):
@@ -60,8 +61,8 @@ class GOAT():
                     realUserMat = torch.tensor(realUserList).float()
                     fakeUserMat = torch.zeros_like(realUserMat)
                     Z = torch.randn(fakeUserMat.shape)
-                    fakeRatings = self.G(Z.cuda())
-                    loss1 = (self.D(fakeRatings) - self.D(realUserMat.cuda())).mean()
+                    fakeRatings = self.G(Z.to(get_device()))
+                    loss1 = (self.D(fakeRatings) - self.D(realUserMat.to(get_device()))).mean()
                     optimize_D.zero_grad()
                     loss1.backward()
                     optimize_D.step()
@@ -73,9 +74,9 @@ class GOAT():
                     realUserMat = torch.tensor(realUserList).float()
                     fakeUserMat = torch.zeros_like(realUserMat)
                     Z = torch.randn(fakeUserMat.shape)
-                    fakeRatings = self.G(Z.cuda())
+                    fakeRatings = self.G(Z.to(get_device()))
                     loss2 = (-self.D(fakeRatings) + 0.01 * (1 / self.k) * torch.linalg.norm(
-                        fakeRatings - realUserMat.cuda())).mean()
+                        fakeRatings - realUserMat.to(get_device()))).mean()
                     optimize_G.zero_grad()
                     loss2.backward()
                     optimize_G.step()
@@ -85,14 +86,14 @@ class GOAT():
         realUserMat = torch.tensor(realUserList).float()
         fakeUserMat = torch.zeros_like(realUserMat)
         Z = torch.randn(fakeUserMat.shape)
-        fakeRatings = self.G(Z.cuda()).cpu()
+        fakeRatings = self.G(Z.to(get_device())).cpu()
         fakeRat = torch.zeros((fakeRatings.shape[0], self.itemNum))
         for step, i in enumerate(realUserList):
             fakeRat[step, I_s[step] + I_f[step]] = fakeRatings[step, :]
             fakeRat[step, self.targetItem] = 1
         fakeRat = self.project(fakeRat, self.maliciousFeedbackNum)
         self.t = fakeRat
-        # print("tureScore:{}".format(self.D(fakeRatings.cuda()).mean()))
+        # print("tureScore:{}".format(self.D(fakeRatings.to(get_device())).mean()))
         return vstack([self.interact, csr_matrix(fakeRat.detach())])
 
     def project(self, mat, n):
@@ -9,6 +9,8 @@ from recommender.LightGCN import LightGCN
 import math
 import argparse
 from conf.recommend_parser import recommend_parse_args
+from util.device import get_device
+from util.graph import bipartite_graph
 
 class LegUP():
     def __init__(self, arg, data):
@@ -29,7 +31,7 @@ class LegUP():
         self.G = None
         self.D = None
         self.lightgcn = LightGCN(self.args, data)
-        self.lightgcn.model = self.lightgcn.model.cuda()
+        self.lightgcn.model = self.lightgcn.model.to(get_device())
 
         # The probability that non-target items are sampled
         self.itemP = np.array((self.interact.sum(0) / self.interact.sum()))[0]
@@ -99,25 +101,8 @@ class LegUP():
                 for k2 in range(epoch2):
                     def fakeUserInject(recommender, user):
                         Pu, Pi = recommender.model()
-                        recommender.data.user_num += 1
-                        recommender.data.user["fakeuser{}".format(recommender.data.user_num)] = len(
-                            recommender.data.user)
-                        recommender.data.id2user[len(recommender.data.user) - 1] = "fakeuser{}".format(
-                            recommender.data.user_num)
-
-                        row, col, entries = [], [], []
-                        for i in self.targetItem:
-                            recommender.data.training_data.append(
-                                (recommender.data.id2user[user], recommender.data.id2item[i]))
-                        for pair in recommender.data.training_data:
-                            row += [recommender.data.user[pair[0]]]
-                            col += [recommender.data.item[pair[1]]]
-                            entries += [1.0]
-
-                        recommender.data.interaction_mat = sp.csr_matrix((entries, (row, col)),
-                                                                         shape=(recommender.data.user_num,
-                                                                                recommender.data.item_num),
-                                                                         dtype=np.float32)
+                        recommender.data.append_users([list(self.targetItem)],
+                                                      ["fakeuser{}".format(recommender.data.user_num + 1)])
 
                         recommender.__init__(recommender.args, recommender.data)
                         with torch.no_grad():
@@ -131,18 +116,15 @@ class LegUP():
                                                                                                  Pu.shape[1] // 2:]
                                 recommender.model.embedding_dict['item_mf_emb'][:] = Pi[:, :Pi.shape[1] // 2]
                                 recommender.model.embedding_dict['item_mlp_emb'][:] = Pi[:, Pi.shape[1] // 2:]
-                        recommender.model = recommender.model.cuda()
+                        recommender.model = recommender.model.to(get_device())
 
                     for T in range(self.Tepoch):
                         fakeUserInject(self.lightgcn, self.userNum)
 
                         uiAdj = self.lightgcn.data.matrix()
                         uiAdj2 = uiAdj[:, :]
-                        ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-                            self.lightgcn.data.user_num + self.itemNum, self.lightgcn.data.user_num + self.itemNum),
-                                               dtype=np.float32)
-                        ui_adj[:self.lightgcn.data.user_num, self.lightgcn.data.user_num:] = uiAdj2
-                        row_indices, col_indices = ui_adj.nonzero()
+                        ui_adj = bipartite_graph(uiAdj2)
+                        row_indices, col_indices = sp.triu(ui_adj).nonzero()
                         num_samples = np.random.randint(int(self.userNum*0.1),int(self.itemNum*0.1))
                         selected_indices = np.random.choice(len(row_indices), num_samples, replace=False)
                         selected_row_indices = row_indices[selected_indices]
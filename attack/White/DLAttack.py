@@ -5,10 +5,12 @@ import os
 import scipy.sparse as sp
 from copy import deepcopy
 from util.tool import targetItemSelect
-from util.sampler import next_batch_pairwise
+from util.sampler import next_batch_pairwise, HardNegativePool
 from scipy.sparse import vstack, csr_matrix
 from util.loss import l2_reg_loss, bpr_loss
 from util.algorithm import find_k_largest
+from util.device import get_device
+from util.graph import bipartite_graph
 
 class DLAttack():
     def __init__(self, arg, data):
@@ -52,35 +54,25 @@ class DLAttack():
         self.fakeUser = list(range(self.userNum, self.userNum + self.fakeUserNum))
         optimizer = torch.optim.Adam(recommender.model.parameters(), lr=recommender.args.lRate / 10)
         topk = min(recommender.topN)
-        p = torch.ones(self.itemNum).cuda()
+        hardNegatives = HardNegativePool(topk, block_size=self.batchSize)
+        p = torch.ones(self.itemNum, device=get_device())
         sigma = 0.8
+        snapshot = None
         for user in self.fakeUser:
             self.fakeUserInject(recommender,user)
             uiAdj = recommender.data.matrix()
             # outer optimization
-            tmpRecommender = deepcopy(recommender)
+            # try the attack on the recommender itself, its parameters are rolled back before the inner training
+            snapshot = recommender.snapshot(snapshot, optimizer)
+            tmpRecommender = recommender
             uiAdj2 = uiAdj[:, :]
-            ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-                tmpRecommender.data.user_num + self.itemNum, tmpRecommender.data.user_num + self.itemNum),
-                                    dtype=np.float32)
-            ui_adj[:tmpRecommender.data.user_num, tmpRecommender.data.user_num:] = uiAdj2
-            tmpRecommender.model._init_uiAdj(ui_adj + ui_adj.T)
+            tmpRecommender.model._init_uiAdj(bipartite_graph(uiAdj2))
             tmpRecommender.train(Epoch=self.innerEpoch, optimizer=optimizer, evalNum=5)
             optimizer_attack = torch.optim.Adam(tmpRecommender.model.parameters(), lr=recommender.args.lRate)
             for _ in range(self.outerEpoch):
                 with torch.no_grad():
                     Pu, Pi = tmpRecommender.model()
-                scores = torch.zeros((uiAdj.shape[0], self.itemNum))
-                for batch in range(0,uiAdj.shape[0], self.batchSize):
-                    scores[batch:batch + self.batchSize, :] = (Pu[batch:batch + self.batchSize, :] \
-                                    @ Pi.T).detach()
-                # scores = torch.matmul(Pu, Pi.transpose(0, 1))
-                nozeroInd = uiAdj2.nonzero()
-                scores[nozeroInd[0],nozeroInd[1]] = -10e8
-                # scores = torch.matmul(Pu, Pi.transpose(0, 1))
-                # scores = scores - 10e8 * torch.tensor(uiAdj2.todense()).cuda()
-                _, top_items = torch.topk(scores, topk)
-                top_items = [[iid.item() for iid in user_top] for user_top in top_items]
+                top_items = hardNegatives.update(Pu, Pi, uiAdj2).items.tolist()
                 for n, batch in enumerate(next_batch_pairwise(self.data, tmpRecommender.args.batch_size)):
                     user_idx, pos_idx, neg_idx = batch
                     rec_user_emb, rec_item_emb = tmpRecommender.model()
@@ -112,13 +104,10 @@ class DLAttack():
             uiAdj2[user, :] = m.cpu()
             p[ind] = p[ind] * sigma
             if max(p) < 1:
-                p = torch.ones(self.itemNum).cuda()
+                p = torch.ones(self.itemNum, device=get_device())
+            recommender.restore(snapshot, optimizer)
 
-            ui_adj = sp.csr_matrix(([], ([], [])), shape=(
-                recommender.data.user_num + self.itemNum, recommender.data.user_num + self.itemNum),
-                                    dtype=np.float32)
-            ui_adj[:recommender.data.user_num, recommender.data.user_num:] = uiAdj2
-            recommender.model._init_uiAdj(ui_adj + ui_adj.T)
+            recommender.model._init_uiAdj(bipartite_graph(uiAdj2))
 
             uiAdj = uiAdj2[:, :]
         self.interact = uiAdj
@@ -133,21 +122,7 @@ class DLAttack():
 
     def fakeUserInject(self, recommender, user):
         Pu, Pi = recommender.model()
-        recommender.data.user_num += 1
-        recommender.data.user["fakeuser{}".format(recommender.data.user_num)] = len(recommender.data.user)
-        recommender.data.id2user[len(recommender.data.user) - 1] = "fakeuser{}".format(recommender.data.user_num)
-
-        row, col, entries = [], [], []
-        for i in self.targetItem:
-            recommender.data.training_data.append((recommender.data.id2user[user], recommender.data.id2item[i]))
-        for pair in recommender.data.training_data:
-            row += [recommender.data.user[pair[0]]]
-            col += [recommender.data.item[pair[1]]]
-            entries += [1.0]
-
-        recommender.data.interaction_mat = sp.csr_matrix((entries, (row, col)),
-                                                         shape=(recommender.data.user_num, recommender.data.item_num),
-                                                         dtype=np.float32)
+        recommender.data.append_users([list(self.targetItem)], ["fakeuser{}".format(recommender.data.user_num + 1)])
 
         recommender.__init__(recommender.args, recommender.data)
         with torch.no_grad():
@@ -160,6 +135,6 @@ class DLAttack():
                 recommender.model.embedding_dict['item_mf_emb'][:] = Pi[:, :Pi.shape[1]//2]
                 recommender.model.embedding_dict['item_mlp_emb'][:] = Pi[:, Pi.shape[1]//2:]
 
-        recommender.model = recommender.model.cuda()
+        recommender.model = recommender.model.to(get_device())
 
 
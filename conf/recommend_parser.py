@@ -10,19 +10,30 @@ def recommend_parse_args():
     parser.add_argument("--training_data", nargs="?", default="/train.txt", help="training data path.")
     parser.add_argument("--val_data", nargs="?", default="/val.txt", help="validation data path.")
     parser.add_argument("--test_data", nargs="?", default="/test.txt", help="test data path.")
+    parser.add_argument("--parse_workers", type=int, default=0, help="processes used to parse the training file, 0 parses in the main process")
+    parser.add_argument("--cache", type=bool, default=True, help="keep a binary cache of the parsed dataset next to the text files")
 
     # ===== model ===== #
     parser.add_argument('--model_name', type=str, default='LightGCN', help='[LightGCN,SGL,NCL,SimGCL,XSimGCL,SSL4Rec...]')
     parser.add_argument('--maxEpoch', type=int, default=30, help='number of epochs')
+    parser.add_argument('--warmEpoch', type=int, default=0, help='epochs of poisoned retraining warm-started from the clean model, 0 retrains from scratch for maxEpoch')
     parser.add_argument('--batch_size', type=int, default=2048, help='batch size')
     parser.add_argument('--emb_size', type=int, default=64, help='embedding size')
     parser.add_argument('--n_layers', type=int, default=2, help='number of gnn layers')
     parser.add_argument('--reg', type=float, default=1e-4, help='regularization weight')
+    parser.add_argument('--patience', type=int, default=0, help='evaluations without validation improvement before training stops, 0 selects the best epoch on the test set')
+    parser.add_argument('--valMetric', type=str, default='NDCG', help='validation metric monitored for early stopping:[Hit Ratio,Precision,Recall,NDCG]')
+    parser.add_argument('--negative', type=str, default='uniform', choices=['uniform', 'popularity', 'hard'], help='negative items of the BPR batches: uniform, popularity weighted or drawn from per-user hard negative pools')
+    parser.add_argument('--negativePool', type=int, default=100, help='size of the per-user hard negative pools')
+    parser.add_argument('--negativeRefresh', type=int, default=1, help='epochs between two rebuilds of the hard negative pools from the embeddings')
     parser.add_argument('--lRate', type=float, default=0.005, help='learning rate')
+    parser.add_argument('--prefetch', type=int, default=2, help='batches prepared ahead by a background thread, 0 disables prefetching')
     parser.add_argument("--dropout", type=bool, default=True, help="consider  dropout or not")
     parser.add_argument("--dropout_rate", type=float, default=0.3, help="ratio of  dropout")
-    parser.add_argument("--cuda", type=bool, default=True, help="use gpu or not")
+    parser.add_argument("--cuda", type=bool, default=True, help="use gpu if there is one, an empty value runs on cpu")
     parser.add_argument("--gpu_id", type=str, default='0', help="gpu id")
+    parser.add_argument("--threads", type=int, default=0, help="cpu threads inside an op, 0 keeps the torch default")
+    parser.add_argument("--interop_threads", type=int, default=0, help="cpu threads across independent ops, 0 keeps the torch default")
     parser.add_argument('--seed', nargs='?', default=2018, help='random seed')
     parser.add_argument('--topK', nargs='?', default='50', help='topK')
 
@@ -30,5 +41,6 @@ def recommend_parse_args():
     parser.add_argument("--load", type=bool, default=True, help="load existed model or not")
     parser.add_argument("--save", type=bool, default=True, help="save model or not")
     parser.add_argument("--save_dir", type=str, default="./modelsaved/", help="output directory for model")
+    parser.add_argument("--save_budget", type=float, default=0, help="disk budget of the saved models in MB, least recently used ones are deleted beyond it, 0 keeps all")
 
     return parser.parse_args()
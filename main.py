@@ -3,6 +3,7 @@ from conf.attack_parser import attack_parse_args
 from conf.recommend_parser import recommend_parse_args
 from util.DataLoader import DataLoader
 from util.tool import seedSet
+from util.device import set_device
 from ARLib import ARLib
 import os
 import torch
@@ -16,7 +17,7 @@ if __name__ == '__main__':
     recommend_args = recommend_parse_args()
     attack_args = attack_parse_args()
     # 2. Import recommend model and attack model
-    os.environ['CUDA_VISIBLE_DEVICES'] = recommend_args.gpu_id
+    set_device(recommend_args.cuda, recommend_args.gpu_id, recommend_args.threads, recommend_args.interop_threads)
     seed = recommend_args.seed
     seedSet(seed)
 
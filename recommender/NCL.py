@@ -1,32 +1,18 @@
 import torch
 import torch.nn as nn
-from util.sampler import next_batch_pairwise
-from util.loss import bpr_loss, l2_reg_loss, InfoNCE
 import torch.nn.functional as F
-import time
-from util.algorithm import find_k_largest
-from time import strftime, localtime, time
-from os.path import abspath
-import sys
-from util.metrics import ranking_evaluation
-from util.FileIO import FileIO
-from util.logger import Log
-import scipy.sparse as sp
-import numpy as np
-# import faiss
+from recommender.base import Recommender
+from util.loss import bpr_loss, l2_reg_loss
+from util.graph import NormalizedGraph, SharedGraph, graph_tensor
 from sklearn.cluster import KMeans
+from util.device import get_device
 
 
-class NCL():
+class NCL(Recommender):
+    print_every = 100
+
     def __init__(self, args, data):
-        print("Recommender: NCL")
-        self.data = data
-        self.args = args
-        self.bestPerformance = []
-        self.recOutput = []
-        top = self.args.topK.split(',')
-        self.topN = [int(num) for num in top]
-        self.max_N = max(self.topN)
+        super(NCL, self).__init__(args, data)
 
         # Hyperparameter
         # SimGCL=-n_layer 2 -lambda 0.5 -eps 0.1
@@ -64,9 +50,9 @@ class NCL():
         # cluster_cents = kmeans.centroids
         I = kmeans.predict(x)
         # _, I = kmeans.index.search(x, 1)
-        # convert to cuda Tensors for broadcast
-        centroids = torch.Tensor(cluster_cents).cuda()
-        node2cluster = torch.LongTensor(I).squeeze().cuda()
+        # convert to device Tensors for broadcast
+        centroids = torch.Tensor(cluster_cents).to(get_device())
+        node2cluster = torch.LongTensor(I).squeeze().to(get_device())
         # print("centroids", centroids)
         # print("node2cluster", node2cluster)
         return centroids, node2cluster
@@ -112,163 +98,36 @@ class NCL():
         ssl_loss = self.ssl_reg * (ssl_loss_user + self.alpha * ssl_loss_item)
         return ssl_loss
 
-    def train(self, requires_adjgrad=False, requires_embgrad=False, gradIterationNum=10, Epoch=0, optimizer=None, evalNum=5):
-        self.bestPerformance=[]
-        model = self.model.cuda()
-        if optimizer is None: optimizer = torch.optim.Adam(model.parameters(), lr=self.args.lRate)
-        if requires_embgrad:
-            model.requires_grad = True
-            self.usergrad = torch.zeros((self.data.user_num, self.args.emb_size)).cuda()
-            self.itemgrad = torch.zeros((self.data.item_num, self.args.emb_size)).cuda()
-        elif requires_adjgrad:
-            self.model.sparse_norm_adj.requires_grad = True
-            self.Matgrad = torch.zeros(
-                (self.data.user_num + self.data.item_num, self.data.user_num + self.data.item_num)).cuda()
-        maxEpoch = self.args.maxEpoch
-        if Epoch: maxEpoch = Epoch
-        for epoch in range(maxEpoch):
-            if epoch >= 5:
-                self.e_step()
-            for n, batch in enumerate(next_batch_pairwise(self.data, self.args.batch_size)):
-                user_idx, pos_idx, neg_idx = batch
-                model.train()
-                rec_user_emb, rec_item_emb = model()
-                sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.data.norm_adj).cuda()
-                ego_embeddings = torch.cat([model.embedding_dict['user_emb'], model.embedding_dict['item_emb']], 0)
-                all_embeddings = [ego_embeddings]
-                for k in range(self.n_layers):
-                    ego_embeddings = torch.sparse.mm(sparse_norm_adj, ego_embeddings)
-                    all_embeddings += [ego_embeddings]
-                emb_list = all_embeddings
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
-                rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
-                initial_emb = emb_list[0]
-                context_emb = emb_list[self.hyper_layers*2]
-                ssl_loss = self.ssl_layer_loss(context_emb,initial_emb,user_idx,pos_idx)
-                warm_up_loss = rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb, neg_item_emb)/self.batch_size  + ssl_loss
-                # Backward and optimize
-                if epoch<5: #warm_up
-                    optimizer.zero_grad()
-                    warm_up_loss.backward()
-                    # optimizer.step()
-                    if n % 100 == 0 and n > 0:
-                        print('training:', epoch + 1, 'batch', n, 'rec_loss:', rec_loss.item(), 'ssl_loss', ssl_loss.item())
-                else:
-                    # Backward and optimize
-                    proto_loss = self.ProtoNCE_loss(initial_emb, user_idx, pos_idx)
-                    batch_loss = rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb, neg_item_emb) / self.batch_size + ssl_loss + proto_loss
-                    optimizer.zero_grad()
-                    batch_loss.backward()
-                    # optimizer.step()
-                    if n % 100 == 0 and n > 0:
-                        print('training:', epoch + 1, 'batch', n, 'rec_loss:', rec_loss.item(), 'ssl_loss', ssl_loss.item(), 'proto_loss', proto_loss.item())
-
-                if requires_adjgrad and maxEpoch - epoch < gradIterationNum:
-                    self.Matgrad += self.model.sparse_norm_adj.grad
-                elif requires_embgrad and maxEpoch - epoch < gradIterationNum:
-                    self.usergrad += self.model.embedding_dict["user_emb"].grad
-                    self.itemgrad += self.model.embedding_dict["item_emb"].grad
-
-                optimizer.step()
-                # if n % 100 == 0:
-                #     print('training:', epoch + 1, 'batch', n, 'rec_loss:', rec_loss.item(), 'cl_loss', cl_loss.item())
-            model.eval()
-            with torch.no_grad():
-                self.user_emb, self.item_emb = self.model()
-            if epoch % evalNum == 0:
-                self.evaluate(epoch)
-        self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
-        if requires_adjgrad and requires_embgrad:
-            return (self.Matgrad + self.Matgrad.T)[:self.data.user_num, self.data.user_num:], \
-                   self.user_emb, self.item_emb, self.usergrad, self.itemgrad
-        elif requires_adjgrad:
-            return (self.Matgrad + self.Matgrad.T)[:self.data.user_num, self.data.user_num:]
-        elif requires_embgrad:
-            return self.user_emb, self.item_emb, self.usergrad, self.itemgrad
-
-    def save(self):
-        with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = self.model.forward()
-
-    def predict(self, u):
-        with torch.no_grad():
-            u = self.data.get_user_id(u)
-            score = torch.matmul(self.user_emb[u], self.item_emb.transpose(0, 1))
-            return score.cpu().numpy()
-
-    def evaluate(self, epoch):
-        print('Evaluating the model...')
-        rec_list, _ = self.test()
-        measure = ranking_evaluation(self.data.test_set, rec_list, [self.max_N])
-        if len(self.bestPerformance) > 0:
-            count = 0
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
-            for k in self.bestPerformance[1]:
-                if self.bestPerformance[1][k] > performance[k]:
-                    count += 1
-                else:
-                    count -= 1
-            if count < 0:
-                self.bestPerformance[1] = performance
-                self.bestPerformance[0] = epoch + 1
-                self.save()
-        else:
-            self.bestPerformance.append(epoch + 1)
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
-            self.bestPerformance.append(performance)
-            self.save()
-        print('-' * 120)
-        print('Real-Time Ranking Performance ' + ' (Top-' + str(self.max_N) + ' Item Recommendation)')
-        measure = [m.strip() for m in measure[1:]]
-        print('*Current Performance*')
-        print('Epoch:', str(epoch + 1) + ',', '  |  '.join(measure))
-        bp = ''
-        # for k in self.bestPerformance[1]:
-        #     bp+=k+':'+str(self.bestPerformance[1][k])+' | '
-        bp += 'Hit Ratio' + ':' + str(self.bestPerformance[1]['Hit Ratio']) + '  |  '
-        bp += 'Precision' + ':' + str(self.bestPerformance[1]['Precision']) + '  |  '
-        bp += 'Recall' + ':' + str(self.bestPerformance[1]['Recall']) + '  |  '
-        # bp += 'F1' + ':' + str(self.bestPerformance[1]['F1']) + ' | '
-        bp += 'NDCG' + ':' + str(self.bestPerformance[1]['NDCG'])
-        print('*Best Performance* ')
-        print('Epoch:', str(self.bestPerformance[0]) + ',', bp)
-        print('-' * 120)
-        return measure
+    def start_epoch(self, epoch):
+        if epoch >= 5:
+            self.e_step()
 
-    def test(self):
-        def process_bar(num, total):
-            rate = float(num) / total
-            ratenum = int(50 * rate)
-            r = '\rProgress: [{}{}]{}%'.format('+' * ratenum, ' ' * (50 - ratenum), ratenum*2)
-            sys.stdout.write(r)
-            sys.stdout.flush()
-
-        # predict
-        rec_list = {}
-        user_count = len(self.data.test_set)
-        for i, user in enumerate(self.data.test_set):
-            candidates = self.predict(user)
-            # predictedItems = denormalize(predictedItems, self.data.rScale[-1], self.data.rScale[0])
-            rated_list, li = self.data.user_rated(user)
-            for item in rated_list:
-                candidates[self.data.item[item]] = -10e8
-            ids, scores = find_k_largest(self.max_N, candidates)
-            item_names = [self.data.id2item[iid] for iid in ids]
-            rec_list[user] = list(zip(item_names, scores))
-            if i % 1000 == 0:
-                process_bar(i, user_count)
-        process_bar(user_count, user_count)
-        print('')
-        return rec_list,ranking_evaluation(self.data.test_set, rec_list, self.topN)
+    def batch_loss(self, model, batch, epoch):
+        user_idx, pos_idx, neg_idx = batch
+        rec_user_emb, rec_item_emb = model()
+        sparse_norm_adj = graph_tensor(self.data, 'norm_adj')
+        ego_embeddings = torch.cat([model.embedding_dict['user_emb'], model.embedding_dict['item_emb']], 0)
+        all_embeddings = [ego_embeddings]
+        for k in range(self.n_layers):
+            ego_embeddings = torch.sparse.mm(sparse_norm_adj, ego_embeddings)
+            all_embeddings += [ego_embeddings]
+        emb_list = all_embeddings
+        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+        rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
+        initial_emb = emb_list[0]
+        context_emb = emb_list[self.hyper_layers*2]
+        ssl_loss = self.ssl_layer_loss(context_emb,initial_emb,user_idx,pos_idx)
+        if epoch<5: #warm_up
+            warm_up_loss = rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb, neg_item_emb)/self.batch_size  + ssl_loss
+            return warm_up_loss, {'rec_loss': rec_loss, 'ssl_loss': ssl_loss}
+        proto_loss = self.ProtoNCE_loss(initial_emb, user_idx, pos_idx)
+        batch_loss = rec_loss + l2_reg_loss(self.reg, user_emb, pos_item_emb, neg_item_emb) / self.batch_size + ssl_loss + proto_loss
+        return batch_loss, {'rec_loss': rec_loss, 'ssl_loss': ssl_loss, 'proto_loss': proto_loss}
 
 
 class LGCN_Encoder(nn.Module):
+    sparse_norm_adj = SharedGraph()
+
     def __init__(self, data, emb_size, n_layers):
         super(LGCN_Encoder, self).__init__()
         self.data = data
@@ -276,12 +135,13 @@ class LGCN_Encoder(nn.Module):
         self.layers = n_layers
         self.norm_adj = data.norm_adj
         self.embedding_dict = self._init_model()
-        self.sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.norm_adj).cuda()
+        self.sparse_norm_adj = graph_tensor(data, 'norm_adj')
 
     def _init_uiAdj(self, ui_adj):
-        self.sparse_norm_adj = sp.diags(np.array((1 / np.sqrt(ui_adj.sum(1)))).flatten()) @ ui_adj @ sp.diags(
-            np.array((1 / np.sqrt(ui_adj.sum(0)))).flatten())
-        self.sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.sparse_norm_adj).cuda()
+        # renormalize incrementally from the previous adjacency, only changed rows/cols are rescaled
+        if getattr(self, 'norm_graph', None) is None:
+            self.norm_graph = NormalizedGraph(ui_adj, self.embedding_dict['user_emb'].device)
+        self.sparse_norm_adj = self.norm_graph.update(ui_adj)
         
     def _init_model(self):
         initializer = nn.init.xavier_uniform_
@@ -305,17 +165,6 @@ class LGCN_Encoder(nn.Module):
         return user_all_embeddings, item_all_embeddings
 
 
-class TorchGraphInterface(object):
-    def __init__(self):
-        pass
-
-    @staticmethod
-    def convert_sparse_mat_to_tensor(X):
-        coo = X.tocoo()
-        i = torch.LongTensor([coo.row, coo.col])
-        v = torch.from_numpy(coo.data).float()
-        return torch.sparse.FloatTensor(i, v, coo.shape)
-
 def InfoNCE(view1, view2, temperature: float, b_cos: bool = True):
     """
     Args:
@@ -1,30 +1,19 @@
 import torch
 import torch.nn as nn
-from util.sampler import next_batch_pairwise
+from recommender.base import Recommender
 from util.loss import bpr_loss, l2_reg_loss, InfoNCE
-import time
-from util.algorithm import find_k_largest
-from time import strftime, localtime, time
-from os.path import abspath
-import sys
-from util.metrics import ranking_evaluation
-from util.FileIO import FileIO
-from util.logger import Log
+from util.graph import NormalizedGraph, SharedGraph, graph_tensor, sparse_tensor
 import numpy as np
 import random
 import scipy.sparse as sp
+from util.device import get_device
 
 
-class SGL():
+class SGL(Recommender):
+    print_every = 100
+
     def __init__(self, args, data):
-        print("Recommender: SGL")
-        self.data = data
-        self.args = args
-        self.bestPerformance = []
-        self.recOutput = []
-        top = self.args.topK.split(',')
-        self.topN = [int(num) for num in top]
-        self.max_N = max(self.topN)
+        super(SGL, self).__init__(args, data)
 
         # Hyperparameter
         # SGL=-n_layer 2 -lambda 0.1 -droprate 0.1 -augtype 2 -temp 0.2
@@ -35,149 +24,61 @@ class SGL():
         self.temp = 0.2
         self.model = SGL_Encoder(self.data, self.args.emb_size, self.drop_rate, self.n_layers, self.temp, self.aug_type)
 
-
-    def train(self, requires_adjgrad=False, requires_embgrad=False, gradIterationNum=10, Epoch=0, optimizer=None,
-              evalNum=5):
-        self.bestPerformance = []
-        model = self.model.cuda()
-        if optimizer is None: optimizer = torch.optim.Adam(model.parameters(), lr=self.args.lRate)
-        if requires_adjgrad: gradAll = torch.zeros(self.data.user_num, self.data.item_num).cuda()
-        if requires_embgrad:
+    def init_grad(self):
+        # the adjacency gradient is taken w.r.t. the two dropped views of each epoch
+        if self.requires_adjgrad: self.gradAll = torch.zeros(self.data.user_num, self.data.item_num, device=get_device())
+        if self.requires_embgrad:
             self.model.requires_grad = True
-            self.usergrad = torch.zeros((self.data.user_num, self.args.emb_size)).cuda()
-            self.itemgrad = torch.zeros((self.data.item_num, self.args.emb_size)).cuda()
-        maxEpoch = self.args.maxEpoch
-        if Epoch: maxEpoch = Epoch
-        for epoch in range(maxEpoch):
-            dropped_adj1 = model.graph_reconstruction()
-            dropped_adj2 = model.graph_reconstruction()
-            if requires_adjgrad:
-                grad_mat1 = torch.zeros_like(dropped_adj1)
-                grad_mat2 = torch.zeros_like(dropped_adj2)
-                if isinstance(dropped_adj1, list):
-                    for i in range(self.n_layers):
-                        dropped_adj1[i].requires_grad = True
-                        dropped_adj2[i].requires_grad = True
-                else:
-                    dropped_adj1.requires_grad = True
-                    dropped_adj2.requires_grad = True
-            for n, batch in enumerate(next_batch_pairwise(self.data, self.args.batch_size)):
-                user_idx, pos_idx, neg_idx = batch
-                rec_user_emb, rec_item_emb = model()
-                user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[
-                    neg_idx]
-                rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
-                cl_loss = self.cl_rate * model.cal_cl_loss([user_idx, pos_idx], dropped_adj1, dropped_adj2)
-                batch_loss = rec_loss + l2_reg_loss(self.args.reg, user_emb, pos_item_emb) + cl_loss
-                optimizer.zero_grad()
-                batch_loss.backward()
-
-                if requires_adjgrad:
-                    grad_mat1 += dropped_adj1.grad
-                    grad_mat2 += dropped_adj2.grad
-                optimizer.step()
-                if n % 100 == 0:
-                    print('training:', epoch + 1, 'batch', n, 'rec_loss:', rec_loss.item(), 'cl_loss', cl_loss.item())
-            if requires_adjgrad and maxEpoch - epoch < gradIterationNum:
-                gradAll += (grad_mat1 + grad_mat2).to_dense()[:self.data.user_num, self.data.user_num:]
-            elif requires_embgrad and maxEpoch - epoch < gradIterationNum:
-                self.usergrad += self.model.embedding_dict["user_emb"].grad
-                self.itemgrad += self.model.embedding_dict["item_emb"].grad
-            with torch.no_grad():
-                self.user_emb, self.item_emb = self.model()
-            if epoch % evalNum == 0:
-                self.evaluate(epoch)
-        self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
-        if requires_adjgrad and requires_embgrad:
-            return gradAll, self.user_emb, self.item_emb, self.usergrad, self.itemgrad
-        elif requires_adjgrad:
-            return gradAll
-        elif requires_embgrad:
+            self.usergrad = torch.zeros((self.data.user_num, self.args.emb_size), device=get_device())
+            self.itemgrad = torch.zeros((self.data.item_num, self.args.emb_size), device=get_device())
+
+    def start_epoch(self, epoch):
+        self.dropped_adj1 = self.model.graph_reconstruction()
+        self.dropped_adj2 = self.model.graph_reconstruction()
+        if self.requires_adjgrad:
+            self.grad_mat1 = torch.zeros_like(self.dropped_adj1)
+            self.grad_mat2 = torch.zeros_like(self.dropped_adj2)
+            if isinstance(self.dropped_adj1, list):
+                for i in range(self.n_layers):
+                    self.dropped_adj1[i].requires_grad = True
+                    self.dropped_adj2[i].requires_grad = True
+            else:
+                self.dropped_adj1.requires_grad = True
+                self.dropped_adj2.requires_grad = True
+
+    def batch_loss(self, model, batch, epoch):
+        user_idx, pos_idx, neg_idx = batch
+        rec_user_emb, rec_item_emb = model()
+        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+        rec_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb)
+        cl_loss = self.cl_rate * model.cal_cl_loss([user_idx, pos_idx], self.dropped_adj1, self.dropped_adj2)
+        batch_loss = rec_loss + l2_reg_loss(self.args.reg, user_emb, pos_item_emb) + cl_loss
+        return batch_loss, {'rec_loss': rec_loss, 'cl_loss': cl_loss}
+
+    def accumulate_grad(self):
+        if self.requires_adjgrad:
+            self.grad_mat1 += self.dropped_adj1.grad
+            self.grad_mat2 += self.dropped_adj2.grad
+
+    def end_epoch(self, epoch, record):
+        if self.requires_adjgrad and record:
+            self.gradAll += (self.grad_mat1 + self.grad_mat2).to_dense()[:self.data.user_num, self.data.user_num:]
+        elif self.requires_embgrad and record:
+            self.usergrad += self.model.embedding_dict["user_emb"].grad
+            self.itemgrad += self.model.embedding_dict["item_emb"].grad
+
+    def gradients(self):
+        if self.requires_adjgrad and self.requires_embgrad:
+            return self.gradAll, self.user_emb, self.item_emb, self.usergrad, self.itemgrad
+        elif self.requires_adjgrad:
+            return self.gradAll
+        elif self.requires_embgrad:
             return self.user_emb, self.item_emb, self.usergrad, self.itemgrad
 
-    def save(self):
-        with torch.no_grad():
-            self.best_user_emb, self.best_item_emb = self.model.forward()
-
-    def predict(self, u):
-        with torch.no_grad():
-            u = self.data.get_user_id(u)
-            score = torch.matmul(self.user_emb[u], self.item_emb.transpose(0, 1))
-            return score.cpu().numpy()
-
-    def evaluate(self, epoch):
-        print('Evaluating the model...')
-        rec_list, _ = self.test()
-        measure = ranking_evaluation(self.data.test_set, rec_list, [self.max_N])
-        if len(self.bestPerformance) > 0:
-            count = 0
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
-            for k in self.bestPerformance[1]:
-                if self.bestPerformance[1][k] > performance[k]:
-                    count += 1
-                else:
-                    count -= 1
-            if count < 0:
-                self.bestPerformance[1] = performance
-                self.bestPerformance[0] = epoch + 1
-                self.save()
-        else:
-            self.bestPerformance.append(epoch + 1)
-            performance = {}
-            for m in measure[1:]:
-                k, v = m.strip().split(':')
-                performance[k] = float(v)
-            self.bestPerformance.append(performance)
-            self.save()
-        print('-' * 120)
-        print('Real-Time Ranking Performance ' + ' (Top-' + str(self.max_N) + ' Item Recommendation)')
-        measure = [m.strip() for m in measure[1:]]
-        print('*Current Performance*')
-        print('Epoch:', str(epoch + 1) + ',', '  |  '.join(measure))
-        bp = ''
-        # for k in self.bestPerformance[1]:
-        #     bp+=k+':'+str(self.bestPerformance[1][k])+' | '
-        bp += 'Hit Ratio' + ':' + str(self.bestPerformance[1]['Hit Ratio']) + '  |  '
-        bp += 'Precision' + ':' + str(self.bestPerformance[1]['Precision']) + '  |  '
-        bp += 'Recall' + ':' + str(self.bestPerformance[1]['Recall']) + '  |  '
-        # bp += 'F1' + ':' + str(self.bestPerformance[1]['F1']) + ' | '
-        bp += 'NDCG' + ':' + str(self.bestPerformance[1]['NDCG'])
-        print('*Best Performance* ')
-        print('Epoch:', str(self.bestPerformance[0]) + ',', bp)
-        print('-' * 120)
-        return measure
-
-    def test(self):
-        def process_bar(num, total):
-            rate = float(num) / total
-            ratenum = int(50 * rate)
-            r = '\rProgress: [{}{}]{}%'.format('+' * ratenum, ' ' * (50 - ratenum), ratenum*2)
-            sys.stdout.write(r)
-            sys.stdout.flush()
-
-        # predict
-        rec_list = {}
-        user_count = len(self.data.test_set)
-        for i, user in enumerate(self.data.test_set):
-            candidates = self.predict(user)
-            # predictedItems = denormalize(predictedItems, self.data.rScale[-1], self.data.rScale[0])
-            rated_list, li = self.data.user_rated(user)
-            for item in rated_list:
-                candidates[self.data.item[item]] = -10e8
-            ids, scores = find_k_largest(self.max_N, candidates)
-            item_names = [self.data.id2item[iid] for iid in ids]
-            rec_list[user] = list(zip(item_names, scores))
-            if i % 1000 == 0:
-                process_bar(i, user_count)
-        process_bar(user_count, user_count)
-        print('')
-        return rec_list,ranking_evaluation(self.data.test_set, rec_list, self.topN)
-
 
 class SGL_Encoder(nn.Module):
+    sparse_norm_adj = SharedGraph()
+
     def __init__(self, data, emb_size, drop_rate, n_layers, temp, aug_type):
         super(SGL_Encoder, self).__init__()
         self.data = data
@@ -188,12 +89,13 @@ class SGL_Encoder(nn.Module):
         self.aug_type = aug_type
         self.norm_adj = data.norm_adj
         self.embedding_dict = self._init_model()
-        self.sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.norm_adj).cuda()
+        self.sparse_norm_adj = graph_tensor(data, 'norm_adj')
 
     def _init_uiAdj(self, ui_adj):
-        self.sparse_norm_adj = sp.diags(np.array((1 / np.sqrt(ui_adj.sum(1)))).flatten()) @ ui_adj @ sp.diags(
-            np.array((1 / np.sqrt(ui_adj.sum(0)))).flatten())
-        self.sparse_norm_adj = TorchGraphInterface.convert_sparse_mat_to_tensor(self.sparse_norm_adj).cuda()
+        # renormalize incrementally from the previous adjacency, only changed rows/cols are rescaled
+        if getattr(self, 'norm_graph', None) is None:
+            self.norm_graph = NormalizedGraph(ui_adj, self.embedding_dict['user_emb'].device)
+        self.sparse_norm_adj = self.norm_graph.update(ui_adj)
 
     def _init_model(self):
         initializer = nn.init.xavier_uniform_
@@ -224,7 +126,7 @@ class SGL_Encoder(nn.Module):
         elif self.aug_type == 1 or self.aug_type == 2:
             dropped_mat = GraphAugmentor.edge_dropout(self.data.interaction_mat, self.drop_rate)
         dropped_mat = self.data.convert_to_laplacian_mat(dropped_mat)
-        return TorchGraphInterface.convert_sparse_mat_to_tensor(dropped_mat).cuda()
+        return sparse_tensor(dropped_mat, get_device())
 
     def forward(self, perturbed_adj=None):
         ego_embeddings = torch.cat([self.embedding_dict['user_emb'], self.embedding_dict['item_emb']], 0)
@@ -244,8 +146,8 @@ class SGL_Encoder(nn.Module):
         return user_all_embeddings, item_all_embeddings
 
     def cal_cl_loss(self, idx, perturbed_mat1, perturbed_mat2):
-        u_idx = torch.unique(torch.Tensor(idx[0]).type(torch.long)).cuda()
-        i_idx = torch.unique(torch.Tensor(idx[1]).type(torch.long)).cuda()
+        u_idx = torch.unique(torch.Tensor(idx[0]).type(torch.long)).to(get_device())
+        i_idx = torch.unique(torch.Tensor(idx[1]).type(torch.long)).to(get_device())
         user_view_1, item_view_1 = self.forward(perturbed_mat1)
         user_view_2, item_view_2 = self.forward(perturbed_mat2)
         view1 = torch.cat((user_view_1[u_idx], item_view_1[i_idx]), 0)
@@ -253,18 +155,6 @@ class SGL_Encoder(nn.Module):
         return InfoNCE(view1, view2, self.temp)
 
 
-class TorchGraphInterface(object):
-    def __init__(self):
-        pass
-
-    @staticmethod
-    def convert_sparse_mat_to_tensor(X):
-        coo = X.tocoo()
-        i = torch.LongTensor([coo.row, coo.col])
-        v = torch.from_numpy(coo.data).float()
-        return torch.sparse.FloatTensor(i, v, coo.shape)
-
-
 class GraphAugmentor(object):
     def __init__(self):
         pass
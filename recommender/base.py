@@ -0,0 +1,343 @@
+import os
+import json
+import torch
+import numpy as np
+from util.sampler import next_batch_pairwise, prefetch, popularity_table, HardNegativePool
+from util.loss import bpr_loss, l2_reg_loss
+from util.algorithm import top_k_items
+from util.metrics import ranking_metrics, format_ranking
+from util.graph import trainable
+from util.device import get_device
+
+
+class Recommender(object):
+    """
+    train/save/predict/evaluate/test shared by every recommender. A subclass builds self.model, an encoder whose
+    forward() returns the user and item embeddings, and overrides the hooks its training differs in:
+    batch_loss() for the loss of one batch, start_epoch()/end_epoch() around the batches of an epoch,
+    embedding_params() and init_grad()/accumulate_grad()/gradients() for the gradients handed to attacks
+    """
+    # batches between two printed losses
+    print_every = 1000
+
+    def __init__(self, args, data):
+        print("Recommender: " + type(self).__name__)
+        self.data = data
+        self.args = args
+        self.bestPerformance = []
+        self.recOutput = []
+        top = self.args.topK.split(',')
+        self.topN = [int(num) for num in top]
+        self.max_N = max(self.topN)
+
+    def batch_loss(self, model, batch, epoch):
+        """
+        loss of one (user, positive item, negative item) batch and the named parts printed with it
+        """
+        user_idx, pos_idx, neg_idx = batch
+        rec_user_emb, rec_item_emb = model()
+        user_emb, pos_item_emb, neg_item_emb = rec_user_emb[user_idx], rec_item_emb[pos_idx], rec_item_emb[neg_idx]
+        batch_loss = bpr_loss(user_emb, pos_item_emb, neg_item_emb) + l2_reg_loss(self.args.reg, user_emb, pos_item_emb)
+        return batch_loss, {'batch_loss': batch_loss}
+
+    def start_epoch(self, epoch):
+        pass
+
+    def end_epoch(self, epoch, record):
+        pass
+
+    def negative_sampler(self):
+        """
+        negatives of the BPR batches chosen by --negative, None for uniform draws
+        """
+        if self.args.negative == 'popularity':
+            return popularity_table(self.data)
+        if self.args.negative == 'hard':
+            return HardNegativePool(self.args.negativePool, refresh=self.args.negativeRefresh)
+        return None
+
+    def embedding_params(self):
+        """
+        user and item embedding parameters, the gradients of each list are concatenated along the embedding axis
+        """
+        return [self.model.embedding_dict['user_emb']], [self.model.embedding_dict['item_emb']]
+
+    def init_grad(self):
+        if self.requires_embgrad:
+            self.model.requires_grad = True
+            users, items = self.embedding_params()
+            self.usergrad = torch.zeros((self.data.user_num, sum(p.shape[1] for p in users)), device=get_device())
+            self.itemgrad = torch.zeros((self.data.item_num, sum(p.shape[1] for p in items)), device=get_device())
+        elif self.requires_adjgrad:
+            self.model.sparse_norm_adj = trainable(self.model.sparse_norm_adj)
+            self.Matgrad = torch.zeros(
+                (self.data.user_num + self.data.item_num, self.data.user_num + self.data.item_num), device=get_device())
+
+    def accumulate_grad(self):
+        """
+        add the gradients of the current batch, called during the last gradIterationNum epochs
+        """
+        if self.requires_adjgrad:
+            self.Matgrad += self.model.sparse_norm_adj.grad
+        elif self.requires_embgrad:
+            users, items = self.embedding_params()
+            self.usergrad += torch.cat([p.grad for p in users], 1)
+            self.itemgrad += torch.cat([p.grad for p in items], 1)
+
+    def gradients(self):
+        if self.requires_adjgrad and self.requires_embgrad:
+            return (self.Matgrad + self.Matgrad.T)[:self.data.user_num, self.data.user_num:], \
+                   self.user_emb, self.item_emb, self.usergrad, self.itemgrad
+        elif self.requires_adjgrad:
+            return (self.Matgrad + self.Matgrad.T)[:self.data.user_num, self.data.user_num:]
+        elif self.requires_embgrad:
+            return self.user_emb, self.item_emb, self.usergrad, self.itemgrad
+
+    def train(self, requires_adjgrad=False, requires_embgrad=False, gradIterationNum=10, Epoch=0, optimizer=None, evalNum=5):
+        self.bestPerformance = []
+        # with a patience the best epoch is chosen on the validation set and the test set is ranked once at the end
+        early_stop = self.args.patience > 0 and len(self.data.val_set) > 0
+        self.bestValidation, self.badRounds = [], 0
+        model = self.model.to(get_device())
+        self.optimizer = torch.optim.Adam(model.parameters(), lr=self.args.lRate) if optimizer is None else optimizer
+        self.requires_adjgrad, self.requires_embgrad = requires_adjgrad, requires_embgrad
+        self.init_grad()
+        maxEpoch = self.args.maxEpoch
+        if Epoch: maxEpoch = Epoch
+        negative = self.negative_sampler()
+        if isinstance(negative, HardNegativePool):
+            with torch.no_grad():
+                negative.update(*model(), self.data.rating_mat)
+        for epoch in range(maxEpoch):
+            record = maxEpoch - epoch < gradIterationNum
+            self.start_epoch(epoch)
+            model.train()
+            for n, batch in enumerate(prefetch(next_batch_pairwise(self.data, self.args.batch_size, as_tensor=True, negative=negative), self.args.prefetch)):
+                batch_loss, parts = self.batch_loss(model, batch, epoch)
+                self.optimizer.zero_grad()
+                batch_loss.backward()
+                if record:
+                    self.accumulate_grad()
+                self.optimizer.step()
+                if n % self.print_every == 0:
+                    print('training:', epoch + 1, 'batch', n, *[v for k in parts for v in (k + ':', parts[k].item())])
+            self.end_epoch(epoch, record)
+            model.eval()
+            with torch.no_grad():
+                self.user_emb, self.item_emb = self.model()
+            if isinstance(negative, HardNegativePool):
+                # rebuilt every negativeRefresh epochs from the embeddings of the epoch just finished
+                negative.update(self.user_emb, self.item_emb, self.data.rating_mat)
+            if epoch % evalNum == 0:
+                if not early_stop:
+                    self.evaluate(epoch)
+                elif self.validate(epoch):
+                    print('Early stopping at epoch', epoch + 1)
+                    break
+        self.user_emb, self.item_emb = self.best_user_emb, self.best_item_emb
+        if early_stop:
+            self.final_test()
+        return self.gradients()
+
+    def validate(self, epoch):
+        """
+        score the current embeddings on the validation set and snapshot them when the monitored metric improves
+        :return: True once the metric has not improved for `patience` evaluations in a row
+        """
+        users, truth = self.data.ground_truth('val')
+        ids, _ = top_k_items(self.user_emb, self.item_emb, users, self.max_N, exclude=self.data.rating_mat)
+        value = ranking_metrics(ids, truth, [self.max_N])[self.max_N][self.args.valMetric]
+        if len(self.bestValidation) == 0 or value > self.bestValidation[1]:
+            self.bestValidation = [epoch + 1, value]
+            self.badRounds = 0
+            self.save()
+        else:
+            self.badRounds += 1
+        print('Validation', self.args.valMetric + '@' + str(self.max_N), 'epoch:', epoch + 1, value,
+              '| best epoch:', self.bestValidation[0], self.bestValidation[1])
+        return self.badRounds >= self.args.patience
+
+    def final_test(self):
+        _, measure = self.test()
+        self.bestPerformance = [self.bestValidation[0], measure[self.max_N]]
+        print('-' * 120)
+        print('Test Performance ' + ' (Top-' + str(self.max_N) + ' Item Recommendation)')
+        print('Epoch:', str(self.bestPerformance[0]) + ',',
+              '  |  '.join(m.strip() for m in format_ranking({self.max_N: measure[self.max_N]})[1:]))
+        print('-' * 120)
+
+    def warm_start(self, state, data):
+        """
+        initialize from the parameters of the same model trained on `data`. Embedding rows of the users and items
+        present in both datasets are copied by id, the others (fake users) keep their fresh initialization, the
+        remaining parameters are copied when their shapes agree
+        :param state: state_dict of the trained encoder
+        :param data: DataLoader the state was trained on
+        """
+        rows = {'user': self._shared_rows(data.id2user.tokens, self.data.user),
+                'item': self._shared_rows(data.id2item.tokens, self.data.item)}
+        with torch.no_grad():
+            for name, param in self.model.state_dict().items():
+                if name not in state:
+                    continue
+                value = state[name].to(param.device)
+                if name.startswith('embedding_dict.'):
+                    src, dst = rows['user' if 'user' in name else 'item']
+                    param[dst.to(param.device)] = value[src.to(param.device)]
+                elif value.shape == param.shape:
+                    param.copy_(value)
+
+    @staticmethod
+    def _shared_rows(tokens, index):
+        src, dst = [], []
+        for i, token in enumerate(tokens):
+            j = index.get(token)
+            if j is not None:
+                src.append(i)
+                dst.append(j)
+        return torch.tensor(src, dtype=torch.long), torch.tensor(dst, dtype=torch.long)
+
+    def snapshot(self, buffers=None, optimizer=None):
+        """
+        copy the encoder parameters, and the state of `optimizer` when given, into preallocated buffers.
+        Pass the buffers of the previous snapshot to reuse them, they are reallocated only when a shape changed.
+        The graph and the last computed embeddings are kept by reference: training and _init_uiAdj replace them
+        and never write into them, NormalizedGraph hands out a tensor with its own values on every update
+        :return: buffers for restore()
+        """
+        if buffers is None:
+            buffers = {}
+        params = buffers.setdefault('params', {})
+        with torch.no_grad():
+            for name, value in self.model.state_dict().items():
+                if name not in params or params[name].shape != value.shape:
+                    params[name] = torch.empty_like(value)
+                params[name].copy_(value)
+            if optimizer is not None:
+                saved = {p: s for p, s in buffers.get('optimizer', {}).items() if p in optimizer.state}
+                buffers['optimizer'] = self._copy_state(optimizer.state, saved)
+        buffers['graph'] = getattr(self.model, 'sparse_norm_adj', None)
+        buffers['emb'] = {name: getattr(self, name, None)
+                          for name in ('user_emb', 'item_emb', 'best_user_emb', 'best_item_emb')}
+        buffers['bestPerformance'] = list(self.bestPerformance)
+        return buffers
+
+    def restore(self, buffers, optimizer=None):
+        """
+        write a snapshot back in place, parameters stay the same tensors so optimizers bound to them remain valid
+        """
+        with torch.no_grad():
+            for name, value in self.model.state_dict().items():
+                value.copy_(buffers['params'][name])
+            if optimizer is not None and 'optimizer' in buffers:
+                for param in list(optimizer.state):
+                    if param not in buffers['optimizer']:
+                        del optimizer.state[param]
+                self._copy_state(buffers['optimizer'], optimizer.state)
+        if buffers['graph'] is not None:
+            self.model.sparse_norm_adj = buffers['graph']
+        for name, value in buffers['emb'].items():
+            if value is not None:
+                setattr(self, name, value)
+        self.bestPerformance = list(buffers['bestPerformance'])
+
+    @staticmethod
+    def _copy_state(src, dst):
+        # per-parameter optimizer state, tensors are copied into the existing ones of the same shape
+        for param, state in src.items():
+            target = dst.setdefault(param, {})
+            for k, v in state.items():
+                if torch.is_tensor(v) and torch.is_tensor(target.get(k)) and target[k].shape == v.shape:
+                    target[k].copy_(v)
+                else:
+                    target[k] = v.clone() if torch.is_tensor(v) else v
+        return dst
+
+    def save_checkpoint(self, path):
+        """
+        write the encoder state_dict, the best embeddings as .npy files that load_checkpoint memory-maps, the
+        hyperparameters and the digest of the training data into the directory `path`. The DataLoader, the
+        graph tensors and the optimizer are left out, they are rebuilt from the data on load
+        """
+        os.makedirs(path, exist_ok=True)
+        torch.save({k: v.detach().cpu() for k, v in self.model.state_dict().items()}, os.path.join(path, 'model.pt'))
+        np.save(os.path.join(path, 'user_emb.npy'), self.best_user_emb.detach().cpu().numpy())
+        np.save(os.path.join(path, 'item_emb.npy'), self.best_item_emb.detach().cpu().numpy())
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'model': type(self).__name__, 'digest': self.data.digest, 'args': vars(self.args),
+                       'bestPerformance': self.bestPerformance}, f, indent=1, default=str)
+
+    @classmethod
+    def load_checkpoint(cls, path, args, data):
+        """
+        rebuild a recommender written by save_checkpoint on an already loaded DataLoader
+        :param args: hyperparameters of the new instance, normally the ones the checkpoint was trained with
+        :param data: DataLoader of the dataset the checkpoint was trained on, checked against the stored digest
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['model'] != cls.__name__:
+            raise ValueError('checkpoint of {} can not be loaded into {}'.format(meta['model'], cls.__name__))
+        if meta['digest'] != data.digest:
+            raise ValueError('checkpoint {} was trained on other data than {}'.format(path, args.dataset))
+        rec = cls(args, data)
+        rec.model.load_state_dict(torch.load(os.path.join(path, 'model.pt'), map_location='cpu', weights_only=True))
+        rec.model = rec.model.to(get_device())
+        # copy-on-write maps, the file pages are only read when the embeddings are used
+        user_emb = torch.from_numpy(np.load(os.path.join(path, 'user_emb.npy'), mmap_mode='c')).to(get_device())
+        item_emb = torch.from_numpy(np.load(os.path.join(path, 'item_emb.npy'), mmap_mode='c')).to(get_device())
+        rec.user_emb, rec.item_emb = rec.best_user_emb, rec.best_item_emb = user_emb, item_emb
+        rec.bestPerformance = meta['bestPerformance']
+        return rec
+
+    def save(self):
+        with torch.no_grad():
+            self.best_user_emb, self.best_item_emb = self.model.forward()
+
+    def predict(self, u):
+        with torch.no_grad():
+            u = self.data.get_user_id(u)
+            score = torch.matmul(self.user_emb[u], self.item_emb.transpose(0, 1))
+            return score.cpu().numpy()
+
+    def evaluate(self, epoch):
+        print('Evaluating the model...')
+        _, measure = self.test()
+        performance = measure[self.max_N]
+        if len(self.bestPerformance) > 0:
+            count = 0
+            for k in self.bestPerformance[1]:
+                if self.bestPerformance[1][k] > performance[k]:
+                    count += 1
+                else:
+                    count -= 1
+            if count < 0:
+                self.bestPerformance[1] = performance
+                self.bestPerformance[0] = epoch + 1
+                self.save()
+        else:
+            self.bestPerformance.append(epoch + 1)
+            self.bestPerformance.append(performance)
+            self.save()
+        print('-' * 120)
+        print('Real-Time Ranking Performance ' + ' (Top-' + str(self.max_N) + ' Item Recommendation)')
+        measure = [m.strip() for m in format_ranking({self.max_N: performance})[1:]]
+        print('*Current Performance*')
+        print('Epoch:', str(epoch + 1) + ',', '  |  '.join(measure))
+        bp = ''
+        bp += 'Hit Ratio' + ':' + str(self.bestPerformance[1]['Hit Ratio']) + '  |  '
+        bp += 'Precision' + ':' + str(self.bestPerformance[1]['Precision']) + '  |  '
+        bp += 'Recall' + ':' + str(self.bestPerformance[1]['Recall']) + '  |  '
+        bp += 'NDCG' + ':' + str(self.bestPerformance[1]['NDCG'])
+        print('*Best Performance* ')
+        print('Epoch:', str(self.bestPerformance[0]) + ',', bp)
+        print('-' * 120)
+        return measure
+
+    def test(self):
+        # rank all items for the test users in blocks, training items are masked out
+        users, truth = self.data.ground_truth('test')
+        ids, scores = top_k_items(self.user_emb, self.item_emb, users, self.max_N, exclude=self.data.rating_mat)
+        item_names = np.asarray(self.data.id2item.tokens, dtype=object)[ids].tolist()
+        rec_list = {user: list(zip(names, s)) for user, names, s in zip(self.data.test_set, item_names, scores.tolist())}
+        return rec_list, ranking_metrics(ids, truth, self.topN)
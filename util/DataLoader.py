@@ -1,46 +1,460 @@
+import os
 import numpy as np
 from collections import defaultdict
+from collections.abc import Mapping, MutableMapping, Sequence
 from util.FileIO import FileIO
 import scipy.sparse as sp
 import pickle
+from itertools import count
+
+CACHE_NAME = '.dataset_cache.{}{}.npz'
+CACHE_VERSION = '3'
+# source of data versions for loaders whose interactions changed after loading
+_versions = count(1)
+
+
+def factorize(tokens):
+    """
+    map raw id tokens to contiguous int32 indices, numbered in order of first appearance
+    :param tokens: sequence of raw ids
+    :return: (codes: np.int32 array, uniques: list of raw ids indexed by code)
+    """
+    tokens = np.asarray(tokens)
+    if len(tokens) == 0:
+        return np.zeros(0, dtype=np.int32), []
+    uniques, first, inverse = np.unique(tokens, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int32)
+    rank[order] = np.arange(len(order), dtype=np.int32)
+    return rank[inverse.ravel()], uniques[order].tolist()
+
+
+class IndexView(MutableMapping):
+    """
+    int index -> raw id view over a token list, replaces the id2user/id2item dicts.
+    New ids can only be assigned to the next free index.
+    """
+    def __init__(self, tokens):
+        self.tokens = tokens
+
+    def __getitem__(self, idx):
+        if 0 <= idx < len(self.tokens):
+            return self.tokens[idx]
+        raise KeyError(idx)
+
+    def __setitem__(self, idx, token):
+        if idx == len(self.tokens):
+            self.tokens.append(token)
+        elif 0 <= idx < len(self.tokens):
+            self.tokens[idx] = token
+        else:
+            raise KeyError(idx)
+
+    def __delitem__(self, idx):
+        raise TypeError('ids can not be removed from an IndexView')
+
+    def __contains__(self, idx):
+        try:
+            return 0 <= idx < len(self.tokens)
+        except TypeError:
+            return False
+
+    def __iter__(self):
+        return iter(range(len(self.tokens)))
+
+    def __len__(self):
+        return len(self.tokens)
+
+
+class RatedRow(Mapping):
+    """
+    raw id -> rating view over one row of a compressed sparse matrix
+    """
+    __slots__ = ('indices', 'values', 'index', 'tokens')
+
+    def __init__(self, indices, values, index, tokens):
+        self.indices = indices
+        self.values = values
+        self.index = index
+        self.tokens = tokens
+
+    def _position(self, key):
+        j = self.index.get(key)
+        if j is None:
+            return -1
+        pos = int(np.searchsorted(self.indices, j))
+        if pos < len(self.indices) and self.indices[pos] == j:
+            return pos
+        return -1
+
+    def __contains__(self, key):
+        return self._position(key) >= 0
+
+    def __getitem__(self, key):
+        pos = self._position(key)
+        if pos < 0:
+            raise KeyError(key)
+        return float(self.values[pos])
+
+    def __iter__(self):
+        return (self.tokens[j] for j in self.indices.tolist())
+
+    def __len__(self):
+        return len(self.indices)
+
+
+class RatingView(Mapping):
+    """
+    raw id -> {raw id: rating} view over the rating matrix, replaces training_set_u/training_set_i.
+    Unknown keys give an empty row, like the defaultdict it replaces.
+    """
+    def __init__(self, data, by_user=True):
+        self.data = data
+        self.by_user = by_user
+
+    def _parts(self):
+        if self.by_user:
+            return self.data.rating_mat, self.data.user, self.data.item, self.data.id2item.tokens
+        return self.data.rating_mat_csc, self.data.item, self.data.user, self.data.id2user.tokens
+
+    def __getitem__(self, key):
+        mat, index, other_index, other_tokens = self._parts()
+        idx = index.get(key)
+        if idx is None or idx >= mat.shape[0 if self.by_user else 1]:
+            return RatedRow(np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.float32), other_index, other_tokens)
+        start, end = mat.indptr[idx], mat.indptr[idx + 1]
+        return RatedRow(mat.indices[start:end], mat.data[start:end], other_index, other_tokens)
+
+    def __contains__(self, key):
+        mat, index, _, _ = self._parts()
+        idx = index.get(key)
+        return idx is not None and idx < len(mat.indptr) - 1 and mat.indptr[idx + 1] > mat.indptr[idx]
+
+    def __iter__(self):
+        mat, _, _, _ = self._parts()
+        tokens = self.data.id2user.tokens if self.by_user else self.data.id2item.tokens
+        counts = np.diff(mat.indptr)
+        return (tokens[k] for k in np.flatnonzero(counts).tolist())
+
+    def __len__(self):
+        mat, _, _, _ = self._parts()
+        return int(np.count_nonzero(np.diff(mat.indptr)))
+
+
+class InteractionList(Sequence):
+    """
+    [user, item, rating] rows over the interaction arrays, replaces the training_data list.
+    append() buffers new (user, item[, rating]) entries, they are merged on the next array access.
+    """
+    def __init__(self, data):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data.user_idx)
+
+    def __getitem__(self, idx):
+        data = self.data
+        if isinstance(idx, slice):
+            return [self[k] for k in range(*idx.indices(len(self)))]
+        u, i, r = data.user_idx[idx], data.item_idx[idx], data.rating[idx]
+        return [data.id2user.tokens[u], data.id2item.tokens[i], float(r)]
+
+    def __iter__(self):
+        data = self.data
+        users, items = data.id2user.tokens, data.id2item.tokens
+        for u, i, r in zip(data.user_idx.tolist(), data.item_idx.tolist(), data.rating.tolist()):
+            yield [users[u], items[i], r]
+
+    def append(self, entry):
+        self.data._pending.append(entry)
+
+    def extend(self, entries):
+        self.data._pending.extend(entries)
+
+
+def bipartite_adjacency(interaction):
+    """
+    symmetric (user number + item number)^2 adjacency of a user x item matrix, assembled
+    from the CSR/CSC index arrays of the interaction block without any sparse slicing
+    """
+    csr = sp.csr_matrix(interaction)
+    csc = csr.tocsc()
+    n_users, n_items = csr.shape
+    indptr = np.concatenate([csr.indptr, csr.nnz + csc.indptr[1:]]).astype(np.int64)
+    indices = np.concatenate([csr.indices.astype(np.int64) + n_users, csc.indices])
+    data = np.concatenate([csr.data, csc.data]).astype(np.float32)
+    adj = sp.csr_matrix((data, indices, indptr), shape=(n_users + n_items, n_users + n_items))
+    adj.sort_indices()
+    return adj
+
+
+def normalize_adjacency(adj):
+    """
+    D^-1/2 A D^-1/2 of a square sparse matrix, computed on its CSR arrays
+    """
+    adj = sp.csr_matrix(adj)
+    rowsum = np.asarray(adj.sum(1)).ravel()
+    with np.errstate(divide='ignore'):
+        d_inv = np.power(rowsum, -0.5)
+    d_inv[np.isinf(d_inv)] = 0.
+    rows = np.repeat(np.arange(adj.shape[0]), np.diff(adj.indptr))
+    data = adj.data * d_inv[rows] * d_inv[adj.indices]
+    return sp.csr_matrix((data.astype(np.float32), adj.indices.copy(), adj.indptr.copy()), shape=adj.shape)
+
+
+def _pack_sparse(cache, name, mat):
+    mat = mat.tocsr()
+    cache[name + '_data'] = mat.data
+    cache[name + '_indices'] = mat.indices
+    cache[name + '_indptr'] = mat.indptr
+    cache[name + '_shape'] = np.array(mat.shape, dtype=np.int64)
+
+
+def _unpack_sparse(cache, name):
+    return sp.csr_matrix((cache[name + '_data'], cache[name + '_indices'], cache[name + '_indptr']),
+                         shape=tuple(cache[name + '_shape']))
+
+
+def _rows(columns):
+    """
+    [user, item, rating] rows of the columns returned by FileIO.load_data_columns
+    """
+    return [list(entry) for entry in zip(*(column.tolist() for column in columns))]
+
 
 class DataLoader():
     def __init__(self, args):
-        self.training_data = FileIO.load_data_set(args.data_path + args.dataset + args.training_data)
-        self.val_data = FileIO.load_data_set(args.data_path + args.dataset + args.val_data)
-        self.test_data = FileIO.load_data_set(args.data_path + args.dataset + args.test_data)
+        training_path = args.data_path + args.dataset + args.training_data
+        val_path = args.data_path + args.dataset + args.val_data
+        test_path = args.data_path + args.dataset + args.test_data
+        # content hash of the source files, it keys the binary cache
+        self.digest = FileIO.file_digest([training_path, val_path, test_path], salt=CACHE_VERSION)
+        self.cache_dir = os.path.dirname(training_path) if args.cache else None
+        # training files sharing a directory get their own cache files
+        self.cache_stem = os.path.splitext(os.path.basename(training_path))[0]
+        # identifies the current interactions, loaders of the same files share it until they are modified
+        self.version = self.digest
 
         self.dataName=args.dataset
         self.user = {}
         self.item = {}
-        self.id2user = {}
-        self.id2item = {}
-        self.training_set_u = defaultdict(dict)
-        self.training_set_i = defaultdict(dict)
+        self.id2user = IndexView([])
+        self.id2item = IndexView([])
+        self._pending = []
+        self._graphs = {}
+        self._graph_cache_valid = True
+        self.training_data = InteractionList(self)
+        self.training_set_u = RatingView(self, by_user=True)
+        self.training_set_i = RatingView(self, by_user=False)
         self.val_set = defaultdict(dict)
         self.val_set_item = set()
         self.test_set = defaultdict(dict)
         self.test_set_item = set()
-        self.__generate_set()
-        self.user_num = len(self.training_set_u)
-        self.item_num = len(self.training_set_i)
-        self.ui_adj = self.__create_sparse_bipartite_adjacency()
-        self.norm_adj = self.normalize_graph_mat(self.ui_adj)
-        self.interaction_mat = self.__create_sparse_interaction_matrix()
+        self._truth = {}
+        if not self.__load_cache():
+            training_columns = FileIO.load_data_columns(training_path, workers=args.parse_workers)
+            self.val_columns = FileIO.load_data_columns(val_path)
+            self.test_columns = FileIO.load_data_columns(test_path)
+            self.__generate_set(training_columns)
+            self.user_num = len(self.user)
+            self.item_num = len(self.item)
+            self.__save_cache()
         #     popularity_item[self.item[u]] = len(self.training_set_i[u])
 
-    def __generate_set(self):
-        for entry in self.training_data:
-            user, item, rating = entry
-            if user not in self.user:
-                self.user[user] = len(self.user)
-                self.id2user[self.user[user]] = user
-            if item not in self.item:
-                self.item[item] = len(self.item)
-                self.id2item[self.item[item]] = item
-                # userList.append
-            self.training_set_u[user][item] = rating
-            self.training_set_i[item][user] = rating
+    def __read_cache(self, name=''):
+        """
+        arrays of a cache file, None if it is missing or was built from different files
+        """
+        if self.cache_dir is None:
+            return None
+        path = os.path.join(self.cache_dir, CACHE_NAME.format(self.cache_stem, name))
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as f:
+                if str(f['digest']) != self.digest:
+                    return None
+                return {k: f[k] for k in f.files}
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __write_cache(self, cache, name=''):
+        if self.cache_dir is None:
+            return
+        cache['digest'] = np.array(self.digest)
+        path = os.path.join(self.cache_dir, CACHE_NAME.format(self.cache_stem, name))
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, **cache)
+            os.replace(tmp_path, path)
+        except OSError:
+            FileIO.delete_file(tmp_path)
+
+    def __load_cache(self):
+        """
+        restore the id maps, interaction arrays and evaluation sets from the binary cache.
+        return False if there is no cache or it was built from different files
+        """
+        cache = self.__read_cache()
+        if cache is None:
+            return False
+        self.id2user.tokens[:] = cache['user_tokens'].tolist()
+        self.id2item.tokens[:] = cache['item_tokens'].tolist()
+        self.user = {u: n for n, u in enumerate(self.id2user.tokens)}
+        self.item = {i: n for n, i in enumerate(self.id2item.tokens)}
+        self.__set_interactions(cache['user_idx'], cache['item_idx'], cache['rating'],
+                                _unpack_sparse(cache, 'rating_mat'))
+        self.val_columns = cache['val_user'], cache['val_item'], cache['val_rating']
+        self.test_columns = cache['test_user'], cache['test_item'], cache['test_rating']
+        self.__generate_eval_set()
+        self.user_num = len(self.user)
+        self.item_num = len(self.item)
+        return True
+
+    def __save_cache(self):
+        """
+        write the parsed dataset next to the text files, keyed by their content hash
+        """
+        if self.cache_dir is None:
+            return
+        cache = {'user_tokens': np.array(self.id2user.tokens, dtype=np.str_),
+                 'item_tokens': np.array(self.id2item.tokens, dtype=np.str_),
+                 'user_idx': self.user_idx, 'item_idx': self.item_idx, 'rating': self.rating}
+        cache['val_user'], cache['val_item'], cache['val_rating'] = self.val_columns
+        cache['test_user'], cache['test_item'], cache['test_rating'] = self.test_columns
+        _pack_sparse(cache, 'rating_mat', self.rating_mat)
+        self.__write_cache(cache)
+
+    def __graph(self, name, build):
+        """
+        memoized graph matrix: built on first access, or read from its cache file while the
+        interactions still match the source files
+        """
+        self._sync()
+        if name not in self._graphs:
+            cache = self.__read_cache('.' + name) if self._graph_cache_valid else None
+            if cache is not None:
+                self._graphs[name] = _unpack_sparse(cache, name)
+            else:
+                self._graphs[name] = build()
+                if self._graph_cache_valid:
+                    cache = {}
+                    _pack_sparse(cache, name, self._graphs[name])
+                    self.__write_cache(cache, '.' + name)
+        return self._graphs[name]
+
+    @property
+    def ui_adj(self):
+        return self.__graph('ui_adj', self.__create_sparse_bipartite_adjacency)
+
+    @ui_adj.setter
+    def ui_adj(self, mat):
+        self._graphs['ui_adj'] = mat
+        self.__new_version()
+
+    @property
+    def norm_adj(self):
+        return self.__graph('norm_adj', lambda: self.normalize_graph_mat(self.ui_adj))
+
+    @norm_adj.setter
+    def norm_adj(self, mat):
+        self._graphs['norm_adj'] = mat
+        self.__new_version()
+
+    @property
+    def interaction_mat(self):
+        return self.__graph('interaction_mat', self.__create_sparse_interaction_matrix)
+
+    @interaction_mat.setter
+    def interaction_mat(self, mat):
+        self._graphs['interaction_mat'] = mat
+        self.__new_version()
+
+    def append_users(self, user_items, names=None):
+        """
+        append a block of new (fake) users and their interactions. The clean part is only copied,
+        never re-parsed: id maps and interaction arrays are extended, new rows are appended to the
+        CSR matrices and memoized graph matrices are updated from the extended interaction matrix.
+        :param user_items: one list of item indices (without repeats) per new user,
+                           or a sparse matrix with the shape (new user number, item number)
+        :param names: raw ids of the new users, 'fakeuser<index>' by default
+        :return: range of the new user indices
+        """
+        self._sync()
+        item_num = len(self.item)
+        if sp.issparse(user_items):
+            block = sp.csr_matrix(user_items, dtype=np.float32)
+            block.sum_duplicates()
+        else:
+            lengths = [len(items) for items in user_items]
+            indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+            indices = np.fromiter((i for items in user_items for i in items), dtype=np.int32, count=indptr[-1])
+            block = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr),
+                                  shape=(len(user_items), item_num))
+        # the interaction arrays keep the given item order, the CSR rows are sorted
+        item_idx, rating = block.indices.astype(np.int32), block.data.copy()
+        block = block.sorted_indices()
+        start = len(self.user)
+        new_users = range(start, start + block.shape[0])
+        if names is None:
+            names = ['fakeuser{}'.format(u) for u in new_users]
+        for u, name in zip(new_users, names):
+            self.user[name] = u
+            self.id2user[u] = name
+        self.user_num += len(new_users)
+
+        user_idx = np.repeat(np.arange(start, new_users.stop, dtype=np.int32), np.diff(block.indptr))
+        self._user_idx = np.concatenate([self._user_idx, user_idx])
+        self._item_idx = np.concatenate([self._item_idx, item_idx])
+        self._rating = np.concatenate([self._rating, rating])
+        old = self._rating_mat
+        self._rating_mat = sp.csr_matrix((np.concatenate([old.data, block.data]),
+                                          np.concatenate([old.indices, block.indices]).astype(old.indices.dtype),
+                                          np.concatenate([old.indptr, old.nnz + block.indptr[1:]])),
+                                         shape=(new_users.stop, item_num))
+        self._rating_mat_csc = None
+
+        self._graph_cache_valid = False
+        self.__new_version()
+        if 'interaction_mat' in self._graphs:
+            ones = sp.csr_matrix((np.ones(block.nnz, dtype=np.float32), block.indices, block.indptr), shape=block.shape)
+            self._graphs['interaction_mat'] = sp.vstack([self._graphs['interaction_mat'], ones], format='csr')
+        if 'ui_adj' in self._graphs or 'norm_adj' in self._graphs:
+            ui_adj = bipartite_adjacency(self.interaction_mat)
+            if 'ui_adj' in self._graphs:
+                self._graphs['ui_adj'] = ui_adj
+            if 'norm_adj' in self._graphs:
+                self._graphs['norm_adj'] = normalize_adjacency(ui_adj)
+        return new_users
+
+    def invalidate(self):
+        """
+        drop the memoized graph matrices after the interactions changed, they are rebuilt
+        from the interaction arrays on next access and the on-disk cache is no longer used for them
+        """
+        self._graphs.clear()
+        self._graph_cache_valid = False
+        self.__new_version()
+
+    def __new_version(self):
+        self.version = '{}.{}'.format(self.digest, next(_versions))
+
+    def __generate_set(self, training_columns):
+        users, items, ratings = training_columns
+        user_idx, user_tokens = factorize(users)
+        item_idx, item_tokens = factorize(items)
+        self.id2user.tokens[:] = user_tokens
+        self.id2item.tokens[:] = item_tokens
+        self.user = {u: n for n, u in enumerate(user_tokens)}
+        self.item = {i: n for n, i in enumerate(item_tokens)}
+        self.__set_interactions(user_idx, item_idx, np.asarray(ratings, dtype=np.float32))
+        self.__generate_eval_set()
+
+    def __generate_eval_set(self):
+        self._truth = {}
+        self.val_data = _rows(self.val_columns)
+        self.test_data = _rows(self.test_columns)
         for entry in self.val_data:
             user, item, rating = entry
             if user not in self.user:
@@ -54,15 +468,83 @@ class DataLoader():
             self.test_set[user][item] = rating
             self.test_set_item.add(item)
 
+    def __set_interactions(self, user_idx, item_idx, ratings, rating_mat=None):
+        """
+        store the interaction arrays and build the CSR/CSC rating views over them
+        """
+        self._user_idx = np.ascontiguousarray(user_idx, dtype=np.int32)
+        self._item_idx = np.ascontiguousarray(item_idx, dtype=np.int32)
+        self._rating = np.ascontiguousarray(ratings, dtype=np.float32)
+        shape = (len(self.user), len(self.item))
+        if rating_mat is None:
+            # duplicated pairs keep the last rating, as the dict-of-dicts did
+            key = self._user_idx.astype(np.int64) * max(shape[1], 1) + self._item_idx
+            _, last = np.unique(key[::-1], return_index=True)
+            keep = len(key) - 1 - last
+            rating_mat = sp.csr_matrix((self._rating[keep], (self._user_idx[keep], self._item_idx[keep])),
+                                       shape=shape, dtype=np.float32)
+        self._rating_mat = rating_mat
+        self._rating_mat.sort_indices()
+        self._rating_mat_csc = None
+
+    def _sync(self):
+        """
+        merge entries appended through training_data.append() into the interaction arrays
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        self.invalidate()
+        user_idx = np.fromiter((self.user[entry[0]] for entry in pending), dtype=np.int32, count=len(pending))
+        item_idx = np.fromiter((self.item[entry[1]] for entry in pending), dtype=np.int32, count=len(pending))
+        ratings = np.fromiter((entry[2] if len(entry) > 2 else 1.0 for entry in pending), dtype=np.float32,
+                              count=len(pending))
+        self.__set_interactions(np.concatenate([self._user_idx, user_idx]),
+                                np.concatenate([self._item_idx, item_idx]),
+                                np.concatenate([self._rating, ratings]))
+
+    @property
+    def user_idx(self):
+        """int32 user index of every training interaction"""
+        self._sync()
+        return self._user_idx
+
+    @property
+    def item_idx(self):
+        """int32 item index of every training interaction"""
+        self._sync()
+        return self._item_idx
+
+    @property
+    def rating(self):
+        """float32 rating of every training interaction"""
+        self._sync()
+        return self._rating
+
+    @property
+    def rating_mat(self):
+        """CSR rating matrix with the shape (user number, item number)"""
+        self._sync()
+        if self._rating_mat.shape != (len(self.user), len(self.item)):
+            self.__set_interactions(self._user_idx, self._item_idx, self._rating)
+        return self._rating_mat
+
+    @property
+    def rating_mat_csc(self):
+        """CSC view of rating_mat"""
+        rating_mat = self.rating_mat
+        if self._rating_mat_csc is None:
+            self._rating_mat_csc = rating_mat.tocsc()
+            self._rating_mat_csc.sort_indices()
+        return self._rating_mat_csc
+
     def __create_sparse_bipartite_adjacency(self, self_connection=False):
         '''
         return a sparse adjacency matrix with the shape (user number + item number, user number + item number)
         '''
         n_nodes = self.user_num + self.item_num
-        row_idx = [self.user[pair[0]] for pair in self.training_data]
-        col_idx = [self.item[pair[1]] for pair in self.training_data]
-        user_np = np.array(row_idx)
-        item_np = np.array(col_idx)
+        user_np = self.user_idx
+        item_np = self.item_idx
         ratings = np.ones_like(user_np, dtype=np.float32)
         tmp_adj = sp.csr_matrix((ratings, (user_np, item_np + self.user_num)), shape=(n_nodes, n_nodes),dtype=np.float32)
         adj_mat = tmp_adj + tmp_adj.T
@@ -99,12 +581,9 @@ class DataLoader():
         """
         return a sparse adjacency matrix with the shape (user number, item number)
         """
-        row, col, entries = [], [], []
-        for pair in self.training_data:
-            row += [self.user[pair[0]]]
-            col += [self.item[pair[1]]]
-            entries += [1.0]
-        interaction_mat = sp.csr_matrix((entries, (row, col)), shape=(self.user_num,self.item_num),dtype=np.float32)
+        entries = np.ones(len(self.user_idx), dtype=np.float32)
+        interaction_mat = sp.csr_matrix((entries, (self.user_idx, self.item_idx)),
+                                        shape=(len(self.user), len(self.item)), dtype=np.float32)
         return interaction_mat
 
     def get_user_id(self, u):
@@ -146,29 +625,58 @@ class DataLoader():
             return False
 
     def user_rated(self, u):
-        return list(self.training_set_u[u].keys()), list(self.training_set_u[u].values())
+        items, ratings = self.user_rated_idx(self.user[u]) if u in self.user else ([], [])
+        return [self.id2item.tokens[i] for i in list(items)], list(ratings)
 
     def item_rated(self, i):
-        return list(self.training_set_i[i].keys()), list(self.training_set_i[i].values())
+        users, ratings = self.item_rated_idx(self.item[i]) if i in self.item else ([], [])
+        return [self.id2user.tokens[u] for u in list(users)], list(ratings)
+
+    def user_rated_idx(self, u):
+        """
+        item indices and ratings of user index u, as array slices of the CSR matrix
+        """
+        mat = self.rating_mat
+        start, end = mat.indptr[u], mat.indptr[u + 1]
+        return mat.indices[start:end], mat.data[start:end]
+
+    def item_rated_idx(self, i):
+        """
+        user indices and ratings of item index i, as array slices of the CSC matrix
+        """
+        mat = self.rating_mat_csc
+        start, end = mat.indptr[i], mat.indptr[i + 1]
+        return mat.indices[start:end], mat.data[start:end]
+
+    def ground_truth(self, name='test'):
+        """
+        user indices of the val/test set and the CSR matrix of their held-out items, one row per user in
+        set order. Items never seen in training get columns after the training items so they still count
+        :param name: 'test' or 'val'
+        """
+        eval_set = self.test_set if name == 'test' else self.val_set
+        if name not in self._truth:
+            users = np.array([self.user[u] for u in eval_set], dtype=np.int64)
+            extra = {}
+            cols = [self.item[i] if i in self.item else len(self.item) + extra.setdefault(i, len(extra))
+                    for u in eval_set for i in eval_set[u]]
+            indptr = np.cumsum([0] + [len(eval_set[u]) for u in eval_set])
+            truth = sp.csr_matrix((np.ones(len(cols), dtype=np.float32), np.asarray(cols, dtype=np.int64), indptr),
+                                  shape=(len(users), len(self.item) + len(extra)))
+            truth.sum_duplicates()
+            self._truth[name] = users, truth
+        return self._truth[name]
 
     def row(self, u):
-        u = self.id2user[u]
-        k, v = self.user_rated(u)
+        k, v = self.user_rated_idx(u)
         vec = np.zeros(len(self.item))
-        # print vec
-        for pair in zip(k, v):
-            iid = self.item[pair[0]]
-            vec[iid] = pair[1]
+        vec[k] = v
         return vec
 
     def col(self, i):
-        i = self.id2item[i]
-        k, v = self.item_rated(i)
+        k, v = self.item_rated_idx(i)
         vec = np.zeros(len(self.user))
-        # print vec
-        for pair in zip(k, v):
-            uid = self.user[pair[0]]
-            vec[uid] = pair[1]
+        vec[k] = v
         return vec
 
     def matrix(self):
@@ -1,6 +1,9 @@
 import os.path
+import hashlib
 from os import remove
 from re import split
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 
 
 class FileIO(object):
@@ -19,6 +22,19 @@ class FileIO(object):
         if os.path.exists(file_path):
             remove(file_path)
 
+    @staticmethod
+    def file_digest(files, salt=''):
+        """
+        content hash of a list of files, used to key on-disk caches
+        """
+        digest = hashlib.blake2b(salt.encode(), digest_size=16)
+        for file in files:
+            digest.update(str(os.path.getsize(file)).encode())
+            with open(file, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 22), b''):
+                    digest.update(block)
+        return digest.hexdigest()
+
     @staticmethod
     def load_data_set(file):
         data = []
@@ -31,3 +47,71 @@ class FileIO(object):
                 data.append([user_id, item_id, float(weight)])
         return data
 
+    @staticmethod
+    def load_data_columns(file, chunk_size=1 << 26, workers=0):
+        """
+        columnar version of load_data_set: reads the file in chunks of chunk_size bytes and
+        splits each chunk with NumPy instead of parsing line by line
+        :param workers: number of processes the chunks are spread over, 0 parses in this process
+        :return: (user tokens, item tokens, weights) as np.str_, np.str_ and np.float32 arrays
+        """
+        if workers > 1:
+            ranges = FileIO._chunk_ranges(file, chunk_size)
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parts = list(pool.map(FileIO._parse_range, [file] * len(ranges), ranges))
+        else:
+            parts = []
+            with open(file, 'rb') as f:
+                tail = b''
+                for block in iter(lambda: f.read(chunk_size), b''):
+                    block = tail + block
+                    cut = block.rfind(b'\n') + 1
+                    tail = block[cut:]
+                    parts.append(FileIO._parse_chunk(block[:cut]))
+                parts.append(FileIO._parse_chunk(tail))
+        users = np.concatenate([p[0] for p in parts]) if parts else np.zeros(0, dtype=np.str_)
+        items = np.concatenate([p[1] for p in parts]) if parts else np.zeros(0, dtype=np.str_)
+        weights = np.concatenate([p[2] for p in parts]) if parts else np.zeros(0, dtype=np.float32)
+        return users, items, weights
+
+    @staticmethod
+    def _chunk_ranges(file, chunk_size):
+        """
+        byte ranges of about chunk_size bytes that start and end on line boundaries
+        """
+        size = os.path.getsize(file)
+        ranges = []
+        with open(file, 'rb') as f:
+            start = 0
+            while start < size:
+                f.seek(min(start + chunk_size, size))
+                f.readline()
+                end = min(f.tell(), size)
+                ranges.append((start, end))
+                start = end
+        return ranges
+
+    @staticmethod
+    def _parse_range(file, byte_range):
+        start, end = byte_range
+        with open(file, 'rb') as f:
+            f.seek(start)
+            return FileIO._parse_chunk(f.read(end - start))
+
+    @staticmethod
+    def _parse_chunk(chunk):
+        """
+        split a block of whole "user item weight" lines into three columns
+        """
+        tokens = np.array(chunk.split(), dtype=np.bytes_)
+        n_lines = chunk.count(b'\n') + (not chunk.endswith(b'\n'))
+        if len(tokens) != 3 * n_lines:
+            # blank lines or extra columns, keep the first three tokens of every line like load_data_set
+            lines = [line.split()[:3] for line in chunk.split(b'\n') if line.strip()]
+            tokens = np.array([token for line in lines for token in line], dtype=np.bytes_)
+        tokens = tokens.reshape(-1, 3)
+        try:
+            users, items = tokens[:, 0].astype(np.str_), tokens[:, 1].astype(np.str_)
+        except UnicodeDecodeError:
+            users, items = np.char.decode(tokens[:, 0], 'utf-8'), np.char.decode(tokens[:, 1], 'utf-8')
+        return users, items, tokens[:, 2].astype(np.float32)
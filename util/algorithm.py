@@ -3,6 +3,7 @@ from math import sqrt, exp
 from numba import jit
 import heapq
 import numpy as np
+import torch
 
 
 def l1(x):
@@ -165,3 +166,72 @@ def find_k_largest(K, candidates):
     ids = [item[1] for item in n_candidates]
     k_largest_scores = [item[0] for item in n_candidates]
     return ids, k_largest_scores
+
+
+def top_k_items(user_emb, item_emb, users, k, exclude=None, block_size=1024):
+    """
+    top-k items of every user by dot-product score, users are scored block by block
+    (block x all items matmul) on the device of user_emb, CPU included
+    :param user_emb: user embedding tensor or array
+    :param item_emb: item embedding tensor or array
+    :param users: user indices
+    :param k: number of items per user
+    :param exclude: CSR matrix (user number, item number) whose nonzero entries are ranked last, e.g. data.rating_mat
+    :param block_size: number of users per matmul
+    :return: int64 item index array and float32 score array, both of shape (len(users), k), best first
+    """
+    user_emb = torch.as_tensor(user_emb)
+    item_emb = torch.as_tensor(item_emb, device=user_emb.device)
+    users = np.asarray(users, dtype=np.int64).ravel()
+    k = min(k, item_emb.shape[0])
+    ids = np.empty((len(users), k), dtype=np.int64)
+    scores = np.empty((len(users), k), dtype=np.float32)
+    with torch.no_grad():
+        item_t = item_emb.t()
+        for start in range(0, len(users), block_size):
+            block = users[start:start + block_size]
+            score = torch.matmul(user_emb[torch.from_numpy(block).to(user_emb.device)], item_t)
+            if exclude is not None:
+                mask = exclude[block].tocoo()
+                score[torch.from_numpy(mask.row.astype(np.int64)).to(score.device),
+                      torch.from_numpy(mask.col.astype(np.int64)).to(score.device)] = -10e8
+            top_scores, top_ids = torch.topk(score, k, dim=1)
+            ids[start:start + len(block)] = top_ids.cpu().numpy()
+            scores[start:start + len(block)] = top_scores.float().cpu().numpy()
+    return ids, scores
+
+
+def target_ranks(user_emb, item_emb, targets, users=None, exclude=None, block_size=1024):
+    """
+    exact rank of every target item for every user, as the number of items scoring strictly higher.
+    nothing is sorted, each target score is compared with the scores of all items, block by block of users
+    :param targets: target item indices
+    :param users: user indices, all users of user_emb by default
+    :param exclude: CSR matrix (user number, item number) of items that are not counted, e.g. data.rating_mat
+    :param block_size: number of users per matmul
+    :return: int64 array of shape (len(users), len(targets)), 0 is the top position
+    """
+    user_emb = torch.as_tensor(user_emb)
+    item_emb = torch.as_tensor(item_emb, device=user_emb.device)
+    device = user_emb.device
+    targets = torch.from_numpy(np.asarray(targets, dtype=np.int64).ravel()).to(device)
+    users = np.arange(user_emb.shape[0]) if users is None else np.asarray(users, dtype=np.int64).ravel()
+    ranks = np.empty((len(users), len(targets)), dtype=np.int64)
+    with torch.no_grad():
+        item_t = item_emb.t()
+        for start in range(0, len(users), block_size):
+            block = users[start:start + block_size]
+            score = torch.matmul(user_emb[torch.from_numpy(block).to(device)], item_t)
+            target_score = score[:, targets]
+            if exclude is not None:
+                mask = exclude[block].tocoo()
+                score[torch.from_numpy(mask.row.astype(np.int64)).to(device),
+                      torch.from_numpy(mask.col.astype(np.int64)).to(device)] = float('-inf')
+            if device.type == 'cpu':
+                # numpy counts the comparison masks several times faster than torch on CPU
+                score, target_score = score.numpy(), target_score.numpy()
+                higher = [np.count_nonzero(score > target_score[:, [j]], axis=1) for j in range(len(targets))]
+            else:
+                higher = [(score > target_score[:, [j]]).sum(1).cpu().numpy() for j in range(len(targets))]
+            ranks[start:start + len(block)] = np.stack(higher, 1) if higher else 0
+    return ranks
@@ -0,0 +1,37 @@
+import torch
+
+_device = None
+
+
+def set_device(cuda=True, gpu_id='0', threads=0, interop_threads=0):
+    """
+    select the device that recommenders, graph tensors, samplers and attacks allocate on.
+    CUDA is used when it is asked for and available, otherwise everything runs on the CPU
+    :param gpu_id: index of the GPU
+    :param threads: CPU threads used inside an op, 0 keeps the torch default
+    :param interop_threads: CPU threads running independent ops in parallel, 0 keeps the torch default
+    """
+    global _device
+    if cuda and torch.cuda.is_available():
+        _device = torch.device('cuda', int(str(gpu_id).split(',')[0]))
+        torch.cuda.set_device(_device)
+    else:
+        _device = torch.device('cpu')
+    if threads:
+        torch.set_num_threads(threads)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:
+            # torch only accepts it before the first parallel op
+            print('inter-op threads are already fixed at', torch.get_num_interop_threads())
+    return _device
+
+
+def get_device():
+    """
+    the device chosen by set_device(), the first GPU if there is one when it was never called
+    """
+    if _device is None:
+        return set_device(cuda=True)
+    return _device
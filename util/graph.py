@@ -0,0 +1,299 @@
+import weakref
+from collections import OrderedDict
+import numpy as np
+import scipy.sparse as sp
+import torch
+from util.device import get_device
+from util.DataLoader import bipartite_adjacency, normalize_adjacency
+
+# converted graphs kept alive by the cache, the oldest versions are dropped first
+GRAPH_CACHE_SIZE = 4
+_graphs = OrderedDict()
+# every tensor handed out by graph_tensor(), whether still cached or only held by models
+_shared = weakref.WeakValueDictionary()
+
+
+class TorchGraphInterface(object):
+    def __init__(self):
+        pass
+
+    @staticmethod
+    def convert_sparse_mat_to_tensor(X):
+        coo = X.tocoo()
+        i = torch.from_numpy(np.vstack([coo.row, coo.col]).astype(np.int64))
+        v = torch.from_numpy(coo.data).float()
+        return torch.sparse_coo_tensor(i, v, coo.shape)
+
+
+def sparse_tensor(mat, device, layout=torch.sparse_csr):
+    """
+    convert a scipy sparse matrix to a torch sparse tensor on device
+    :param layout: torch.sparse_csr (fastest for torch.sparse.mm) or torch.sparse_coo
+    """
+    mat = sp.csr_matrix(mat, dtype=np.float32)
+    if not mat.has_canonical_format:
+        mat = mat.copy()
+        mat.sum_duplicates()
+    if layout == torch.sparse_coo:
+        return TorchGraphInterface.convert_sparse_mat_to_tensor(mat).coalesce().to(device)
+    return torch.sparse_csr_tensor(torch.from_numpy(mat.indptr.astype(np.int64)),
+                                   torch.from_numpy(mat.indices.astype(np.int64)),
+                                   torch.from_numpy(mat.data), size=mat.shape).to(device)
+
+
+def graph_tensor(data, name='norm_adj', device=None):
+    """
+    the graph matrix data.<name> as a CSR tensor on device (the selected device by default). It is converted
+    once per data version and the same tensor is returned to every model, so it must be treated as read-only
+    """
+    device = get_device() if device is None else device
+    mat = getattr(data, name)
+    key = (data.version, name, str(torch.device(device)))
+    if key in _graphs:
+        _graphs.move_to_end(key)
+    else:
+        tensor = sparse_tensor(mat, device)
+        _graphs[key] = tensor
+        _shared[id(tensor)] = tensor
+        while len(_graphs) > GRAPH_CACHE_SIZE:
+            _graphs.popitem(last=False)
+    return _graphs[key]
+
+
+def bipartite_graph(interaction, normalized=False, device=None):
+    """
+    [[0, R], [R^T, 0]] of a user x item matrix R, the adjacency the attacks hand to _init_uiAdj. It is
+    concatenated from the index arrays of R instead of slice-assigning R into an empty sparse matrix
+    :param normalized: return D^-1/2 A D^-1/2 as a CSR tensor on device (the selected device by default)
+    """
+    adj = bipartite_adjacency(interaction)
+    if not normalized:
+        return adj
+    return sparse_tensor(normalize_adjacency(adj), get_device() if device is None else device)
+
+
+def trainable(tensor):
+    """
+    private COO copy of a graph tensor that gradients can be taken against
+    """
+    return tensor.detach().to_sparse_coo().coalesce().requires_grad_()
+
+
+class _GraphRef(object):
+    __slots__ = ('tensor',)
+
+    def __init__(self, tensor):
+        self.tensor = tensor
+
+    def __deepcopy__(self, memo):
+        tensor = self.tensor
+        if tensor is None or _shared.get(id(tensor)) is tensor:
+            return self
+        copy = tensor.detach().clone()
+        return _GraphRef(copy.requires_grad_() if tensor.requires_grad else copy)
+
+
+class SharedGraph(object):
+    """
+    encoder attribute holding a graph tensor. Tensors from graph_tensor() are passed through
+    deepcopy instead of being copied, private tensors (e.g. of _init_uiAdj) are cloned.
+    """
+    def __set_name__(self, owner, name):
+        self.name = '_' + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        ref = obj.__dict__.get(self.name)
+        return None if ref is None else ref.tensor
+
+    def __set__(self, obj, tensor):
+        obj.__dict__[self.name] = _GraphRef(tensor)
+
+
+class NormalizedGraph(object):
+    """
+    D^-1/2 A D^-1/2 of an adjacency matrix, kept on the device and exposed as a CSR tensor.
+    update() compares the next adjacency with the previous one on the host and only touches
+    the entries that changed plus the rows/columns whose degree changed. Every returned tensor
+    owns its values, tensors returned before an update are left unchanged by it.
+    """
+    def __init__(self, adj, device):
+        self.device = device
+        adj = self._canonical(adj)
+        self.shape = adj.shape
+        self.adj = adj
+        coo = adj.tocoo()
+        self.keys = torch.from_numpy(coo.row.astype(np.int64) * self.shape[1] + coo.col).to(device)
+        self.raw = torch.from_numpy(coo.data).to(device)
+        self.row_degree = torch.from_numpy(np.asarray(adj.sum(1), dtype=np.float32).ravel()).to(device)
+        self.col_degree = torch.from_numpy(np.asarray(adj.sum(0), dtype=np.float32).ravel()).to(device)
+        row, col = self._split(self.keys)
+        self.values = self.raw * self._inv_sqrt(self.row_degree)[row] * self._inv_sqrt(self.col_degree)[col]
+
+    @staticmethod
+    def _canonical(adj):
+        adj = sp.csr_matrix(adj, dtype=np.float32)
+        adj.sum_duplicates()
+        adj.eliminate_zeros()
+        return adj
+
+    @staticmethod
+    def _inv_sqrt(degree):
+        d_inv = degree.pow(-0.5)
+        d_inv[torch.isinf(d_inv)] = 0.
+        return d_inv
+
+    def _split(self, keys):
+        return keys // self.shape[1], keys % self.shape[1]
+
+    def _tensor(self):
+        row, col = self._split(self.keys)
+        # the values are copied, an update keeping the pattern writes self.values in place and must not
+        # change the tensors handed out before it
+        tensor = torch.sparse_coo_tensor(torch.stack([row, col]), self.values.clone(), self.shape,
+                                         check_invariants=False)
+        return tensor._coalesced_(True).to_sparse_csr()
+
+    def _to_device(self, array, dtype):
+        return torch.from_numpy(np.ascontiguousarray(array, dtype=dtype)).to(self.device)
+
+    def update(self, adj):
+        """
+        move to a new adjacency with the same shape and return the normalized tensor
+        """
+        adj = self._canonical(adj)
+        if adj.shape != self.shape:
+            self.__init__(adj, self.device)
+            return self._tensor()
+        delta = (adj - self.adj).tocoo()
+        delta.eliminate_zeros()
+        if delta.nnz == 0:
+            self.adj = adj
+            return self._tensor()
+        changed = sp.csr_matrix((np.ones(delta.nnz, dtype=np.float32), (delta.row, delta.col)), shape=self.shape)
+        added = adj.multiply(changed).tocoo()
+        removed = self.adj.multiply(changed).tocoo()
+        added_keys = self._to_device(added.row.astype(np.int64) * self.shape[1] + added.col, np.int64)
+        removed_keys = self._to_device(removed.row.astype(np.int64) * self.shape[1] + removed.col, np.int64)
+        added_keys, order = torch.sort(added_keys)
+        added_raw = self._to_device(added.data, np.float32)[order]
+        with torch.no_grad():
+            if added.nnz == removed.nnz and torch.equal(added_keys, torch.sort(removed_keys)[0]):
+                # same sparsity pattern, overwrite the changed values in place
+                self.raw[torch.searchsorted(self.keys, added_keys)] = added_raw
+            else:
+                # merge the new entries into the kept ones without re-sorting everything
+                keep = ~torch.isin(self.keys, removed_keys)
+                kept = self.keys[keep]
+                n = len(kept) + len(added_keys)
+                to_kept = torch.arange(len(kept), device=self.device) + torch.searchsorted(added_keys, kept)
+                to_added = torch.arange(len(added_keys), device=self.device) + torch.searchsorted(kept, added_keys)
+                keys = torch.empty(n, dtype=kept.dtype, device=self.device)
+                raw = torch.empty(n, dtype=self.raw.dtype, device=self.device)
+                values = torch.zeros(n, dtype=self.values.dtype, device=self.device)
+                keys[to_kept], keys[to_added] = kept, added_keys
+                raw[to_kept], raw[to_added] = self.raw[keep], added_raw
+                values[to_kept] = self.values[keep]
+                self.keys, self.raw, self.values = keys, raw, values
+            changed_rows = np.unique(delta.row)
+            changed_cols = np.unique(delta.col)
+            row_delta = np.asarray(delta.tocsr().sum(1), dtype=np.float32).ravel()[changed_rows]
+            col_delta = np.asarray(delta.tocsc().sum(0), dtype=np.float32).ravel()[changed_cols]
+            changed_rows = self._to_device(changed_rows, np.int64)
+            changed_cols = self._to_device(changed_cols, np.int64)
+            self.row_degree.index_add_(0, changed_rows, self._to_device(row_delta, np.float32))
+            self.col_degree.index_add_(0, changed_cols, self._to_device(col_delta, np.float32))
+            # rescale only the entries whose row or column degree changed
+            row, col = self._split(self.keys)
+            touched = torch.isin(row, changed_rows) | torch.isin(col, changed_cols)
+            row, col = row[touched], col[touched]
+            self.values[touched] = self.raw[touched] * self._inv_sqrt(self.row_degree[row]) \
+                                   * self._inv_sqrt(self.col_degree[col])
+        self.adj = adj
+        return self._tensor()
+
+
+class PoisonGraph(object):
+    """
+    user x item interactions of a poisoned dataset, the fake users being the last rows. The clean rows are an
+    immutable CSR shared by every copy, the fake rows a dense float block that the attacks overwrite with scores
+    and project back to interactions with vectorized row operations instead of restructuring a sparse matrix
+    """
+    def __init__(self, interaction, user_num):
+        """
+        :param interaction: user x item matrix with the fake users appended, e.g. data.matrix()
+        :param user_num: number of clean users
+        """
+        interaction = sp.csr_matrix(interaction, dtype=np.float32)
+        self.shape = interaction.shape
+        self.clean = interaction[:user_num]
+        self.fake = interaction[user_num:].toarray()
+
+    def copy(self):
+        """
+        the clean part is shared, only the fake block is copied
+        """
+        graph = PoisonGraph.__new__(PoisonGraph)
+        graph.shape, graph.clean, graph.fake = self.shape, self.clean, self.fake.copy()
+        return graph
+
+    def fill(self, items, value=1.):
+        """
+        set the given items of every fake user to value
+        """
+        self.fake[:, items] = value
+
+    def put(self, index, value):
+        """
+        set fake row r at the items index[r] to value, index is a fake users x k array
+        """
+        np.put_along_axis(self.fake, np.asarray(index, dtype=np.int64), value, axis=1)
+
+    def project(self, n, candidates=None):
+        """
+        binarize every fake row to its n highest scores and return the kept items (fake users x n)
+        :param candidates: draw the n items uniformly among the candidates highest scores instead
+        """
+        k = min(candidates or n, self.shape[1])
+        index = torch.topk(torch.from_numpy(self.fake), k, dim=1).indices
+        if k > n:
+            index = torch.gather(index, 1, torch.rand(index.shape).argsort(dim=1)[:, :n])
+        index = index.numpy()
+        self.fake[:] = 0
+        np.put_along_axis(self.fake, index, 1., axis=1)
+        return index
+
+    def tocsr(self):
+        """
+        the whole user x item matrix, the arrays of the clean part are concatenated, never re-indexed
+        """
+        fake = sp.csr_matrix(self.fake)
+        indptr = np.concatenate([self.clean.indptr, self.clean.nnz + fake.indptr[1:]]).astype(np.int64)
+        indices = np.concatenate([self.clean.indices, fake.indices])
+        data = np.concatenate([self.clean.data, fake.data])
+        return sp.csr_matrix((data, indices, indptr), shape=self.shape)
+
+    def adjacency(self):
+        """
+        the symmetric (user number + item number)^2 adjacency, see bipartite_graph
+        """
+        return bipartite_graph(self.tocsr())
+
+    def tensor(self, device=None):
+        """
+        the normalized adjacency as a CSR tensor on device
+        """
+        return bipartite_graph(self.tocsr(), normalized=True, device=device)
+
+    def triples(self):
+        """
+        (row, col, value) arrays of the nonzero entries, the clean ones are read straight from the CSR arrays
+        """
+        clean = self.clean
+        rows = np.repeat(np.arange(clean.shape[0]), np.diff(clean.indptr))
+        keep = clean.data != 0
+        fake_rows, fake_cols = self.fake.nonzero()
+        return (np.concatenate([rows[keep], fake_rows + clean.shape[0]]),
+                np.concatenate([clean.indices[keep], fake_cols]),
+                np.concatenate([clean.data[keep], self.fake[fake_rows, fake_cols]]))
@@ -1,5 +1,7 @@
 import math
 import numpy as np
+import scipy.sparse as sp
+from util.algorithm import target_ranks
 
 class RecommendMetric(object):
     def __init__(self):
@@ -113,6 +115,51 @@ def ranking_evaluation(origin, res, N):
         measure += indicators
     return measure
 
+def ranking_metrics(ranked, truth, N):
+    """
+    hit ratio, precision, recall and NDCG at every cutoff in one vectorized pass
+    :param ranked: int array (user number, K) of item indices, best first
+    :param truth: CSR ground truth with one row per row of ranked (e.g. DataLoader.ground_truth)
+    :param N: cutoffs, none larger than K
+    :return: {n: {'Hit Ratio': .., 'Precision': .., 'Recall': .., 'NDCG': ..}}
+    """
+    ranked = np.asarray(ranked, dtype=np.int64)
+    if ranked.shape[0] != truth.shape[0]:
+        raise ValueError('The Lengths of test set and predicted set do not match!')
+    truth = sp.csr_matrix(truth)
+    truth.sum_duplicates()
+    relevant = np.diff(truth.indptr)
+    # look every ranked (user, item) pair up among the sorted ground-truth keys
+    keys = np.repeat(np.arange(truth.shape[0], dtype=np.int64), relevant) * truth.shape[1] + truth.indices
+    query = np.arange(ranked.shape[0], dtype=np.int64)[:, None] * truth.shape[1] + ranked
+    keys = np.append(keys, -1)
+    hit = keys[np.minimum(np.searchsorted(keys[:-1], query), len(keys) - 1)] == query
+    discount = 1.0 / np.log(np.arange(ranked.shape[1]) + 2)
+    hits = hit.cumsum(1)
+    dcg = (hit * discount).cumsum(1)
+    idcg = np.cumsum(discount)
+    measure = {}
+    for n in N:
+        n_hits = hits[:, n - 1]
+        ndcg = dcg[:, n - 1] / idcg[np.minimum(relevant, n) - 1]
+        measure[n] = {'Hit Ratio': float(n_hits.sum() / relevant.sum()),
+                      'Precision': float(n_hits.sum() / (len(n_hits) * n)),
+                      'Recall': float(np.mean(n_hits / relevant)),
+                      'NDCG': float(np.mean(ndcg))}
+    return measure
+
+
+def format_ranking(measure):
+    """
+    lines of a ranking_metrics result in the ranking_evaluation text format
+    """
+    lines = []
+    for n in measure:
+        lines.append('Top ' + str(n) + '\n')
+        lines += [k + ':' + str(v) + '\n' for k, v in measure[n].items()]
+    return lines
+
+
 def rating_evaluation(res):
     measure = []
     mae = RecommendMetric.MAE(res)
@@ -122,87 +169,159 @@ def rating_evaluation(res):
     return measure
 
 
+class TargetRanks(object):
+    """
+    hit rate, NDCG and MRR of target items at any cutoff, from their exact ranks (util.algorithm.target_ranks)
+    :param ranks: int array (user number, target number), 0 is the top position
+    """
+    def __init__(self, ranks):
+        self.ranks = np.asarray(ranks)
+
+    def hit_rate(self, k):
+        """fraction of (user, target) pairs ranked within the top k"""
+        return float(np.mean(self.ranks < k))
+
+    def ndcg(self, k):
+        hit = self.ranks < k
+        idcg = (1 / np.log2(2 + np.arange(min(k, self.ranks.shape[1])))).sum()
+        return float((hit / np.log2(2 + self.ranks)).sum(1).mean() / idcg)
+
+    def mrr(self, k=None):
+        """mean reciprocal rank, ranks beyond k count as 0"""
+        reciprocal = 1 / (self.ranks + 1.0)
+        if k is not None:
+            reciprocal[self.ranks >= k] = 0
+        return float(reciprocal.mean())
+
+    def histogram(self, bins=None):
+        """
+        number of (user, target) pairs per rank bucket, power-of-two bucket edges 0, 1, 2, 4, ... by default
+        :return: counts, bucket edges
+        """
+        if bins is None:
+            top = max(int(self.ranks.max()) + 1, 1) if self.ranks.size else 1
+            bins = np.concatenate([[0], 2 ** np.arange(int(np.ceil(np.log2(top))) + 1)])
+        return np.histogram(self.ranks, bins=bins)
+
+
+class Estimate(object):
+    """
+    sampled metric value with its confidence interval [low, high] and the number of users it is based on
+    """
+    __slots__ = ('value', 'low', 'high', 'size')
+
+    def __init__(self, value, low, high, size):
+        self.value = value
+        self.low = low
+        self.high = high
+        self.size = size
+
+    def __repr__(self):
+        return '{:.6f} [{:.6f}, {:.6f}] n={}'.format(self.value, self.low, self.high, self.size)
+
+
 class AttackMetric(object):
     """
     param 
     targetItem:list, targetItem: id
+    excludeRated: do not count the items a user rated in training when ranking
+    the rank of every target item for every user is computed once, scoring users in blocks, and every
+    metric at every cutoff is derived from those ranks. The result is cached on the first metric call
     """
-    def __init__(self, recommendModel, targetItem, top=[10]):
+    def __init__(self, recommendModel, targetItem, top=[10], block_size=1024, excludeRated=False):
         self.recommendModel = recommendModel
         self.targetItem = targetItem
         self.top = top
+        self.block_size = block_size
+        self.excludeRated = excludeRated
+        self._ranks = None
+        self._result = None
+
+    def targetRanks(self):
+        """
+        TargetRanks of all users, computed on the first call
+        """
+        if self._ranks is None:
+            data = self.recommendModel.data
+            self._ranks = TargetRanks(target_ranks(self.recommendModel.user_emb, self.recommendModel.item_emb,
+                                                   self.targetItem, np.arange(len(data.user)),
+                                                   data.rating_mat if self.excludeRated else None, self.block_size))
+        return self._ranks
+
+    def ranks(self):
+        """
+        (user number, target number) array, the number of items scoring higher than each target item
+        """
+        return self.targetRanks().ranks
+
+    def MRR(self):
+        return [self.targetRanks().mrr(k) for k in self.top]
+
+    def result(self):
+        """
+        {k: {'HitRate': .., 'Precision': .., 'Recall': .., 'NDCG': ..}} for every cutoff k in top
+        """
+        if self._result is None:
+            targetRanks = self.targetRanks()
+            userNum, targetNum = targetRanks.ranks.shape
+            self._result = {}
+            for k in self.top:
+                hit = targetRanks.ranks < k
+                self._result[k] = {'HitRate': float(hit.any(1).sum() / targetNum / userNum),
+                                   'Precision': float(hit.sum() / (userNum * k)),
+                                   'Recall': targetRanks.hit_rate(k),
+                                   'NDCG': targetRanks.ndcg(k)}
+        return self._result
+
+    def hitRateEstimate(self, k=None, sampleSize=256, versus=None, margin=0.1, z=1.96, strata=4, seed=None):
+        """
+        hitRate at cutoff k (the smallest of top by default) estimated on a user sample stratified by the number
+        of training interactions, for cheap model selection inside attack loops. The sample doubles until the
+        confidence interval excludes versus (e.g. the best hit rate so far), its half width is within margin
+        times the estimate, or it covers every user, in which case the estimate is exact
+        :param z: normal quantile of the interval, 1.96 for 95%
+        :return: Estimate
+        """
+        k = min(self.top) if k is None else k
+        data = self.recommendModel.data
+        userNum, targetNum = len(data.user), len(self.targetItem)
+        # seeded from the global numpy state (see seedSet) so that runs with the same seed select the same graphs
+        rng = np.random.default_rng(np.random.randint(1 << 31) if seed is None else seed)
+        degree = np.diff(data.rating_mat.indptr)[:userNum]
+        groups = [rng.permutation(g) for g in np.array_split(np.argsort(degree, kind='stable'), strata) if len(g)]
+        weights = np.array([len(g) for g in groups]) / userNum
+        taken = np.zeros(len(groups), dtype=np.int64)
+        hits = np.zeros(len(groups))
+        size = min(sampleSize, userNum)
+        while True:
+            want = np.minimum(np.maximum(np.round(size * weights).astype(np.int64), 2), [len(g) for g in groups])
+            new = [g[t:w] for g, t, w in zip(groups, taken, want)]
+            ranks = target_ranks(self.recommendModel.user_emb, self.recommendModel.item_emb, self.targetItem,
+                                 np.concatenate(new), data.rating_mat if self.excludeRated else None, self.block_size)
+            # a user scores 1/targetNum if any target item reaches the top k, as in hitRate()
+            anyHit = (ranks < k).any(1)
+            hits += [part.sum() for part in np.split(anyHit, np.cumsum([len(n) for n in new])[:-1])]
+            taken = want
+            value = float((weights * hits / taken).sum() / targetNum)
+            # smoothed Bernoulli variance per stratum, with the finite population correction
+            p = (hits + 0.5) / (taken + 1)
+            total = np.array([len(g) for g in groups])
+            variance = (weights ** 2 * p * (1 - p) / taken * (1 - taken / total)).sum() / targetNum ** 2
+            half = z * np.sqrt(variance)
+            estimate = Estimate(value, max(value - half, 0.), value + half, int(taken.sum()))
+            if (taken == total).all() or half <= margin * value or \
+                    (versus is not None and not estimate.low <= versus <= estimate.high):
+                return estimate
+            size *= 2
 
     def precision(self):
-        totalNum = [0 for i in range(len(self.top))]
-        hit = [0 for i in range(len(self.top))]
-        for i in self.recommendModel.data.user:
-            score = self.recommendModel.predict(i)
-            result = []
-            for n, k in enumerate(self.top):
-                result.append(np.argsort(-score)[:k])
-                totalNum[n] += k
-            for j in self.targetItem:
-                for k in range(len(self.top)):
-                    if j in result[k]:
-                        hit[k] += 1
-        result = []
-        for i in range(len(self.top)):
-            result.append(hit[i] / totalNum[i])
-        return result
+        return [self.result()[k]['Precision'] for k in self.top]
 
     def hitRate(self):
-        totalNum = [0 for i in range(len(self.top))]
-        hit = [0 for i in range(len(self.top))]
-        for i in self.recommendModel.data.user:
-            score = self.recommendModel.predict(i)
-            result = []
-            for n, k in enumerate(self.top):
-                result.append(np.argsort(-score)[:k])
-                totalNum[n] += 1
-            for k in range(len(self.top)):
-                hit[k] += int(len(set(self.targetItem) & set(result[k])) > 0)/len(self.targetItem)
-        result = []
-        for i in range(len(self.top)):
-            result.append(hit[i] / totalNum[i])
-        return result
+        return [self.result()[k]['HitRate'] for k in self.top]
 
     def recall(self):
-        totalNum = [0 for i in range(len(self.top))]
-        hit = [0 for i in range(len(self.top))]
-        for i in self.recommendModel.data.user:
-            score = self.recommendModel.predict(i)
-            result = []
-            for n, k in enumerate(self.top):
-                result.append(np.argsort(-score)[:k])
-                totalNum[n] += len(self.targetItem)
-            for j in self.targetItem:
-                for k in range(len(self.top)):
-                    if j in result[k]:
-                        hit[k] += 1
-        result = []
-        for i in range(len(self.top)):
-            result.append(hit[i] / totalNum[i])
-        return result
+        return [self.result()[k]['Recall'] for k in self.top]
 
     def NDCG(self):
-        totalNum = [0 for i in range(len(self.top))]
-        hit = [0 for i in range(len(self.top))]
-        for i in self.recommendModel.data.user:
-            score = self.recommendModel.predict(i)
-            result = []
-            for n, k in enumerate(self.top):
-                result.append(np.argsort(-score)[:k])
-                idcg=0
-                for s in range(k):
-                    if s < len(self.targetItem):
-                        idcg+= 1 / np.log2(2 + s)
-                totalNum[n] += idcg
-            for step,r in enumerate(result):
-                for rank,j in enumerate(r):
-                    if j in self.targetItem:
-                        hit[step]+=1 / np.log2(2 + rank)
-        result = []
-        for i in range(len(self.top)):
-            result.append(hit[i] / totalNum[i])
-        return result
-
+        return [self.result()[k]['NDCG'] for k in self.top]
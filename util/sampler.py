@@ -1,141 +1,305 @@
-from random import random, shuffle,randint,choice
-import random as rand
+import numpy as np
+import scipy.sparse as sp
+import torch
+from queue import Queue, Full
+from threading import Thread, Event
+from util.device import get_device
 
-def next_batch_pairwise(data,batch_size):
+
+def _rng(seed=None):
+    '''
+    numpy generator of the vectorized samplers, seeded from the global numpy state (see seedSet) by default
+    '''
+    return np.random.default_rng(np.random.randint(1 << 31) if seed is None else seed)
+
+def _rated_keys(data):
+    '''
+    user * item_num + item of every training interaction, sorted since the CSR rows are
+    '''
+    mat = data.rating_mat
+    rows = np.repeat(np.arange(mat.shape[0], dtype=np.int64), np.diff(mat.indptr))
+    return rows * mat.shape[1] + mat.indices
+
+def sample_negatives(data, users, rng, keys=None, table=None):
+    '''
+    draw one item per user among the items the user did not rate,
+    collisions with the CSR rows are rejected and redrawn in bulk
+    :param keys: output of _rated_keys, recomputed when not given
+    :param table: AliasTable the items are drawn from, uniform when None
+    '''
+    item_num = data.rating_mat.shape[1]
+    if keys is None:
+        keys = _rated_keys(data)
+    if table is None:
+        draw = lambda size: rng.integers(0, item_num, size=size)
+    else:
+        draw = lambda size: table.draw(size, rng)
+    users = np.asarray(users, dtype=np.int64)
+    negs = draw(len(users))
+    todo = np.arange(len(users))
+    while len(todo) and len(keys):
+        query = users[todo] * item_num + negs[todo]
+        pos = np.minimum(np.searchsorted(keys, query), len(keys) - 1)
+        todo = todo[keys[pos] == query]
+        negs[todo] = draw(len(todo))
+    return negs
+
+
+class AliasTable(object):
+    '''
+    Vose's alias method: O(1) draws from a fixed discrete distribution over 0..n-1
+    '''
+    def __init__(self, weights):
+        p = np.asarray(weights, dtype=np.float64)
+        p = p * len(p) / p.sum()
+        self.prob = np.ones(len(p))
+        self.alias = np.arange(len(p))
+        small, large = np.flatnonzero(p < 1).tolist(), np.flatnonzero(p >= 1).tolist()
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s], self.alias[s] = p[s], l
+            p[l] += p[s] - 1
+            (small if p[l] < 1 else large).append(l)
+        # whatever is left over is 1 up to rounding and keeps prob 1
+
+    def draw(self, size, rng):
+        idx = rng.integers(0, len(self.prob), size=size)
+        return np.where(rng.random(size) < self.prob[idx], idx, self.alias[idx])
+
+
+def popularity_table(data, alpha=0.75):
+    '''
+    alias table over items weighted by training popularity ** alpha, items without
+    interactions count once so that every item can still be drawn
+    '''
+    counts = np.bincount(data.item_idx, minlength=len(data.item))
+    return AliasTable(np.maximum(counts, 1) ** alpha)
+
+
+class HardNegativePool(object):
+    '''
+    per-user pools of the pool_size highest scored unrated items, best first. They are rebuilt
+    block by block of users from the embeddings, the user x item score matrix is never materialized.
+    '''
+    def __init__(self, pool_size, refresh=1, block_size=1024):
+        '''
+        :param refresh: the pools are rebuilt on every refresh-th call of update()
+        '''
+        self.pool_size = pool_size
+        self.refresh = refresh
+        self.block_size = block_size
+        self.items = None
+        self.calls = 0
+
+    def update(self, user_emb, item_emb, rated=None, user_num=None):
+        '''
+        :param rated: users x items sparse matrix, its nonzero entries are never pooled (e.g. data.rating_mat)
+        :param user_num: build pools for the first user_num users only, all of them by default
+        '''
+        if self.items is None or self.calls % self.refresh == 0:
+            self.items = self.__build(user_emb, item_emb, rated, user_num)
+        self.calls += 1
+        return self
+
+    def __build(self, user_emb, item_emb, rated, user_num):
+        user_num = user_emb.shape[0] if user_num is None else user_num
+        k = min(self.pool_size, item_emb.shape[0])
+        items = np.empty((user_num, k), dtype=np.int64)
+        if rated is not None:
+            rated = sp.csr_matrix(rated)
+        with torch.no_grad():
+            item_t = item_emb.detach().T
+            for start in range(0, user_num, self.block_size):
+                stop = min(start + self.block_size, user_num)
+                scores = user_emb[start:stop].detach() @ item_t
+                if rated is not None:
+                    block = rated[start:stop].tocoo()
+                    nonzero = block.data != 0
+                    row = torch.from_numpy(block.row[nonzero].astype(np.int64)).to(scores.device)
+                    col = torch.from_numpy(block.col[nonzero].astype(np.int64)).to(scores.device)
+                    scores[row, col] = -10e8
+                items[start:stop] = torch.topk(scores, k).indices.cpu().numpy()
+        return items
+
+    def draw(self, users, rng):
+        '''
+        one item per user drawn uniformly from its pool
+        '''
+        users = np.asarray(users, dtype=np.int64)
+        return self.items[users, rng.integers(0, self.items.shape[1], size=len(users))]
+
+    def cw_triples(self, users, target_items):
+        '''
+        (user, target item, negative item) lists for the attacks' CW loss, every user paired with
+        every target item. The negatives are taken from the bottom of the pool upwards, so with
+        pool_size = K they are the K-th, (K-1)-th... ranked unrated items.
+        '''
+        users = np.asarray(users, dtype=np.int64)
+        n = len(target_items)
+        negs = self.items[users][:, ::-1][:, :n]
+        return np.repeat(users, n).tolist(), np.tile(np.asarray(target_items), len(users)).tolist(), negs.ravel().tolist()
+
+def next_batch_pairwise(data,batch_size,seed=None,as_tensor=False,negative=None):
     '''
     full itemize pair-wise sample by batch
+    :param seed: seed of the shuffle and the negative draws
+    :param as_tensor: yield int64 tensors instead of lists
+    :param negative: uniform negatives when None, popularity weighted ones for an AliasTable
+                     (see popularity_table), pooled hard ones for a HardNegativePool
     '''
-    training_data = data.training_data
-    shuffle(training_data)
-    batch_id = 0
-    data_size = len(training_data)
-    while batch_id < data_size:
-        if batch_id + batch_size <= data_size:
-            users = [training_data[idx][0] for idx in range(batch_id, batch_size + batch_id)]
-            items = [training_data[idx][1] for idx in range(batch_id, batch_size + batch_id)]
-            batch_id += batch_size
+    # the generator is seeded here rather than on first next(), which may run in a prefetch thread
+    return _pairwise_batches(data, batch_size, _rng(seed), as_tensor, negative)
+
+def _pairwise_batches(data, batch_size, rng, as_tensor, negative):
+    user_idx, item_idx = data.user_idx, data.item_idx
+    keys = _rated_keys(data)
+    order = rng.permutation(len(user_idx))
+    for batch_id in range(0, len(order), batch_size):
+        batch = order[batch_id:batch_id + batch_size]
+        u_idx, i_idx = user_idx[batch].astype(np.int64), item_idx[batch].astype(np.int64)
+        if isinstance(negative, HardNegativePool):
+            j_idx = negative.draw(u_idx, rng)
         else:
-            users = [training_data[idx][0] for idx in range(batch_id, data_size)]
-            items = [training_data[idx][1] for idx in range(batch_id, data_size)]
-            batch_id = data_size
-        u_idx, i_idx, j_idx = [], [], []
-        item_list = list(data.item.keys())
-        for i, user in enumerate(users):
-            i_idx.append(data.item[items[i]])
-            u_idx.append(data.user[user])
-            neg_item = choice(item_list)
-            while neg_item in data.training_set_u[user]:
-                neg_item = choice(item_list)
-            j_idx.append(data.item[neg_item])
-        yield u_idx, i_idx, j_idx
-
-
-def next_batch_pointwise(data,batch_size):
+            j_idx = sample_negatives(data, u_idx, rng, keys, table=negative)
+        if as_tensor:
+            yield torch.from_numpy(u_idx), torch.from_numpy(i_idx), torch.from_numpy(j_idx)
+        else:
+            yield u_idx.tolist(), i_idx.tolist(), j_idx.tolist()
+
+
+def _pointwise(data, users, items, neg_num, rng, keys):
+    '''
+    each positive (user, item) followed by neg_num negatives of the same user, labels 1 and 0
+    '''
+    users = np.asarray(users, dtype=np.int64)
+    negs = sample_negatives(data, np.repeat(users, neg_num), rng, keys).reshape(-1, neg_num)
+    u_idx = np.repeat(users, neg_num + 1)
+    i_idx = np.hstack([np.asarray(items, dtype=np.int64)[:, None], negs]).ravel()
+    y = np.tile(np.array([1] + [0] * neg_num), len(users))
+    return u_idx, i_idx, y
+
+def _exclusion_keys(data, exclude):
+    # without exclusion sample_negatives draws uniformly over all items
+    return _rated_keys(data) if exclude else np.zeros(0, dtype=np.int64)
+
+def next_batch_pointwise(data,batch_size,seed=None,exclude=True):
     '''
     full itemize point-wise sample by batch
+    :param exclude: draw negatives only among the items the user did not rate
     '''
-    training_data = data.training_data
-    data_size = len(training_data)
-    batch_id = 0
-    while batch_id < data_size:
-        if batch_id + batch_size <= data_size:
-            users = [training_data[idx][0] for idx in range(batch_id, batch_size + batch_id)]
-            items = [training_data[idx][1] for idx in range(batch_id, batch_size + batch_id)]
-            batch_id += batch_size
-        else:
-            users = [training_data[idx][0] for idx in range(batch_id, data_size)]
-            items = [training_data[idx][1] for idx in range(batch_id, data_size)]
-            batch_id = data_size
-        u_idx, i_idx, y = [], [], []
-        for i, user in enumerate(users):
-            i_idx.append(data.item[items[i]])
-            u_idx.append(data.user[user])
-            y.append(1)
-            for instance in range(4):
-                item_j = randint(0, data.item_num - 1)
-                while data.id2item[item_j] in data.training_set_u[user]:
-                    item_j = randint(0, data.item_num - 1)
-                u_idx.append(data.user[user])
-                i_idx.append(item_j)
-                y.append(0)
-        yield u_idx, i_idx, y
-
-def sample_batch_pointwise(data,batch_size):
+    return _pointwise_batches(data, batch_size, _rng(seed), _exclusion_keys(data, exclude))
+
+def _pointwise_batches(data, batch_size, rng, keys):
+    user_idx, item_idx = data.user_idx, data.item_idx
+    for batch_id in range(0, len(user_idx), batch_size):
+        users, items = user_idx[batch_id:batch_id + batch_size], item_idx[batch_id:batch_id + batch_size]
+        u_idx, i_idx, y = _pointwise(data, users, items, 4, rng, keys)
+        yield u_idx.tolist(), i_idx.tolist(), y.tolist()
+
+def sample_batch_pointwise(data,batch_size,seed=None,exclude=True):
     '''
     one batch point-wise sample, items are not interacted
     '''
-    training_data = data.training_data
-    data_size = len(training_data)
-    idxs = [rand.randint(0,data_size-1) for i in range(batch_size)]
-
-    users = [training_data[idx][0] for idx in idxs]
-    items = [training_data[idx][1] for idx in idxs]
-
-    u_idx, i_idx, y = [], [], []
-    for i, user in enumerate(users):
-        i_idx.append(data.item[items[i]])
-        u_idx.append(data.user[user])
-        y.append(1)
-        for instance in range(4):
-            item_j = randint(0, data.item_num - 1)
-            while data.id2item[item_j] in data.training_set_u[user]:
-                item_j = randint(0, data.item_num - 1)
-            u_idx.append(data.user[user])
-            i_idx.append(item_j)
-            y.append(0)
-    return u_idx, i_idx, y
+    rng = _rng(seed)
+    idxs = rng.integers(0, len(data.user_idx), size=batch_size)
+    u_idx, i_idx, y = _pointwise(data, data.user_idx[idxs], data.item_idx[idxs], 4, rng,
+                                 _exclusion_keys(data, exclude))
+    return u_idx.tolist(), i_idx.tolist(), y.tolist()
 
-def sample_batch_pointwise_p(data,batch_size):
+def sample_batch_pointwise_p(data,batch_size,seed=None):
     '''
     one batch point-wise sample, items can be repeated
     '''
-    training_data = data.training_data
-    data_size = len(training_data)
-    idxs = [rand.randint(0,data_size-1) for i in range(batch_size)]
-
-    users = [training_data[idx][0] for idx in idxs]
-    items = [training_data[idx][1] for idx in idxs]
-
-    u_idx, i_idx, y = [], [], []
-    for i, user in enumerate(users):
-        i_idx.append(data.item[items[i]])
-        u_idx.append(data.user[user])
-        y.append(1)
-    return u_idx, i_idx, y
+    idxs = _rng(seed).integers(0, len(data.user_idx), size=batch_size)
+    return data.user_idx[idxs].tolist(), data.item_idx[idxs].tolist(), [1] * batch_size
 
 
-def next_batch_pointwise_1(data,batch_size):
+def next_batch_pointwise_1(data,batch_size,seed=None,exclude=True):
     '''
     full itemize point-wise sample by batch
     return information in detail
     '''
-    training_data = data.training_data
-    data_size = len(training_data)
-    batch_id = 0
-    while batch_id < data_size:
-        if batch_id + batch_size <= data_size:
-            users = [training_data[idx][0] for idx in range(batch_id, batch_size + batch_id)]
-            items = [training_data[idx][1] for idx in range(batch_id, batch_size + batch_id)]
-            batch_id += batch_size
-        else:
-            users = [training_data[idx][0] for idx in range(batch_id, data_size)]
-            items = [training_data[idx][1] for idx in range(batch_id, data_size)]
-            batch_id = data_size
-        u_idx, i_idx, y, pos_u_idx, pos_i_idx, neg_u_idx, neg_i_idx = [], [], [], [], [], [], []
-
-        for i, user in enumerate(users):
-            i_idx.append(data.item[items[i]])
-            u_idx.append(data.user[user])
-            pos_i_idx.append(data.item[items[i]])
-            pos_u_idx.append(data.user[user])
-            y.append(1)
-            for instance in range(1):
-                item_j = randint(0, data.item_num - 1)
-                while data.id2item[item_j] in data.training_set_u[user]:
-                    item_j = randint(0, data.item_num - 1)
-                u_idx.append(data.user[user])
-                i_idx.append(item_j)
-                neg_u_idx.append(data.user[user])
-                neg_i_idx.append(item_j)                
-                y.append(0)
-        yield u_idx, i_idx, y, pos_u_idx, pos_i_idx, neg_u_idx, neg_i_idx
+    return _pointwise_1_batches(data, batch_size, _rng(seed), _exclusion_keys(data, exclude))
+
+def _pointwise_1_batches(data, batch_size, rng, keys):
+    user_idx, item_idx = data.user_idx, data.item_idx
+    for batch_id in range(0, len(user_idx), batch_size):
+        users, items = user_idx[batch_id:batch_id + batch_size], item_idx[batch_id:batch_id + batch_size]
+        u_idx, i_idx, y = _pointwise(data, users, items, 1, rng, keys)
+        pos_u_idx, pos_i_idx = u_idx[0::2].tolist(), i_idx[0::2].tolist()
+        neg_u_idx, neg_i_idx = u_idx[1::2].tolist(), i_idx[1::2].tolist()
+        yield u_idx.tolist(), i_idx.tolist(), y.tolist(), pos_u_idx, pos_i_idx, neg_u_idx, neg_i_idx
+
+
+class Prefetcher(object):
+    '''
+    iterate a batch generator in a background thread that keeps up to depth batches ready,
+    each as a tuple of contiguous tensors. For a CUDA device they are pinned and copied asynchronously
+    '''
+    _end = object()
+
+    def __init__(self, batches, depth=2, device=None):
+        self.queue = Queue(maxsize=max(1, depth))
+        self.stop = Event()
+        self.device = get_device() if device is None else torch.device(device)
+        self.pin_memory = self.device.type == 'cuda'
+        self.thread = Thread(target=self._work, args=(batches,), daemon=True)
+        self.thread.start()
+
+    def _convert(self, batch):
+        tensors = []
+        for part in batch:
+            tensor = torch.as_tensor(part).contiguous()
+            tensors.append(tensor.pin_memory() if self.pin_memory else tensor)
+        return tuple(tensors)
+
+    def _put(self, item):
+        # give up once the consumer has stopped, instead of blocking on a full queue forever
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                pass
+        return False
+
+    def _work(self, batches):
+        try:
+            for batch in batches:
+                if not self._put(self._convert(batch)):
+                    return
+            self._put(self._end)
+        except Exception as e:
+            self._put(e)
+        finally:
+            if hasattr(batches, 'close'):
+                batches.close()
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is self._end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield tuple(t.to(self.device, non_blocking=True) for t in item) if self.pin_memory else item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def prefetch(batches, depth):
+    '''
+    wrap a batch generator in a Prefetcher, depth 0 iterates it synchronously as before
+    '''
+    return Prefetcher(batches, depth) if depth > 0 else batches
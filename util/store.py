@@ -0,0 +1,122 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # windows, the index is then updated without a lock
+    fcntl = None
+
+# arguments that change where or how fast a model is trained but not the trained model itself,
+# the dataset location is covered by the content digest of the DataLoader
+RUNTIME_ARGS = {'dataset', 'data_path', 'training_data', 'val_data', 'test_data', 'parse_workers', 'cache', 'prefetch',
+                'cuda', 'gpu_id', 'threads', 'interop_threads', 'load', 'save', 'save_dir', 'save_budget', 'warmEpoch'}
+
+
+class ModelStore(object):
+    """
+    content-addressed directory of trained clean models. An entry is keyed by a hash of every recommender
+    hyperparameter and the digest of the dataset it was trained on, so a model is only reused for the exact
+    configuration. index.json records the size, configuration and last use of every entry; once the entries
+    exceed the disk budget the least recently used ones are deleted. Runs sharing the directory update the
+    index under an exclusive lock on index.json.lock
+    """
+    INDEX = 'index.json'
+
+    def __init__(self, root, budget=0):
+        """
+        :param root: directory holding the entries and the index
+        :param budget: disk budget in MB, 0 keeps every entry
+        """
+        self.root = root
+        self.budget = int(budget * (1 << 20))
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def config(args):
+        return {k: v for k, v in sorted(vars(args).items()) if k not in RUNTIME_ARGS}
+
+    @staticmethod
+    def key(args, data):
+        config = json.dumps(ModelStore.config(args), sort_keys=True, default=str)
+        return hashlib.blake2b((config + data.digest).encode(), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key)
+
+    def get(self, key):
+        """
+        directory of the entry, None when it is not stored. The entry becomes the most recently used one
+        """
+        with self._locked():
+            index = self._read_index()
+            if key not in index or not os.path.isdir(self.path(key)):
+                return None
+            index[key]['used'] = time.time()
+            self._write_index(index)
+        return self.path(key)
+
+    def put(self, key, write, meta=None):
+        """
+        store an entry, `write` fills the directory it is given. The files are written aside and moved in place
+        so that concurrent runs never read a partial entry
+        :param meta: extra description recorded in the index, e.g. the configuration
+        """
+        tmp = self.path(key) + '.tmp' + str(os.getpid())
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        write(tmp)
+        with self._locked():
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            os.replace(tmp, self.path(key))
+            index = self._read_index()
+            index[key] = dict(meta or {}, size=self._size(self.path(key)), used=time.time())
+            self._write_index(self.evict(index, keep=key))
+        return self.path(key)
+
+    def evict(self, index, keep=None):
+        """
+        delete least recently used entries until the store fits the budget, `keep` is never deleted.
+        Call it under the lock, a run that got an entry from get() may still find it deleted before loading
+        """
+        if not self.budget:
+            return index
+        total = sum(entry['size'] for entry in index.values())
+        for key in sorted(index, key=lambda k: index[k]['used']):
+            if total <= self.budget:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self.path(key), ignore_errors=True)
+            total -= index.pop(key)['size']
+        return index
+
+    @contextmanager
+    def _locked(self):
+        with open(os.path.join(self.root, self.INDEX + '.lock'), 'a') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _size(path):
+        return sum(os.path.getsize(os.path.join(d, f)) for d, _, files in os.walk(path) for f in files)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.root, self.INDEX)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        tmp = os.path.join(self.root, self.INDEX + '.tmp' + str(os.getpid()))
+        with open(tmp, 'w') as f:
+            json.dump(index, f, indent=1, default=str)
+        os.replace(tmp, os.path.join(self.root, self.INDEX))
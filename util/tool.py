@@ -23,15 +23,18 @@ def getPopularItemId(interact, n):
 def dataSave(ratings, fileName, id2user, id2item):
     """
     sava ratings data
-    :param ratings: np.array ratings matrix
+    :param ratings: np.array ratings matrix or util.graph.PoisonGraph
     :param fileName: str fileName
     :param id2user: dict
     :param id2item: dcit
     """
     ratingList = []
-    ind = ratings.nonzero()
-    for i,j in zip(ind[0].tolist(),ind[1].tolist()):
-            ratingList.append((i,j,ratings[i,j]))
+    if hasattr(ratings, 'triples'):
+        ratingList = zip(*(a.tolist() for a in ratings.triples()))
+    else:
+        ind = ratings.nonzero()
+        for i,j in zip(ind[0].tolist(),ind[1].tolist()):
+                ratingList.append((i,j,ratings[i,j]))
     # for i in range(ratings.shape[0]):
     #     for j in range(ratings.shape[1]):
     #         if ratings[i,j] == 0: continue